@@ -0,0 +1,235 @@
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the balldontlie API: /v1/games, /v1/box_scores and /v1/teams with deterministic
+# synthetic payloads, plus /stats with what was served so the benchmark harness can report on it.
+
+TEAMS = [
+    {'id': i + 1, 'conference': 'East' if i < 15 else 'West', 'division': ['Atlantic', 'Central', 'Southeast', 'Northwest', 'Pacific', 'Southwest'][i // 5],
+     'city': f"City {i + 1}", 'name': f"Team {i + 1}", 'full_name': f"City {i + 1} Team {i + 1}", 'abbreviation': f"T{i + 1:02d}"}
+    for i in range(30)
+]
+POSITIONS = ['G', 'F', 'C', 'G-F', 'F-C', '']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fake balldontlie API for benchmarks")
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--latency_ms', type=float, default=0, help='Added latency per request')
+    parser.add_argument('--jitter_ms', type=float, default=0, help='Uniform random jitter on top of the latency')
+    parser.add_argument('--page_size', type=int, default=100, help='Largest games page served, whatever per_page asks for')
+    parser.add_argument('--rate_429', type=float, default=0, help='Fraction of requests answered with 429 Too Many Requests')
+    parser.add_argument('--retry_after', type=float, default=1, help='Retry-After seconds sent with each 429')
+    parser.add_argument('--dates_per_season', type=int, default=160, help='Game dates in each season')
+    parser.add_argument('--games_per_date', type=int, default=8, help='Games on each date')
+    parser.add_argument('--players_per_team', type=int, default=13, help='Players in each box score side')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for payloads and 429 injection')
+    parser.add_argument('--max_batch_dates', type=int, default=0, help='Most dates[] one box_scores request may ask for, larger ones get 414; 0 refuses dates[] with 400 like the public API')
+    parser.add_argument('--correction_rate', type=float, default=0, help='Fraction of stat lines served with a corrected point total, as after an official stat correction')
+    parser.add_argument('--live_game_seconds', type=float, default=0, help="Play today's games out over this many seconds from startup, 0 for final scores")
+    return parser.parse_args()
+
+# Stat line fields that grow while a game is on
+QUARTERS = ['1st Qtr', '2nd Qtr', '3rd Qtr', '4th Qtr']
+COUNTING_STATS = ['fgm', 'fga', 'fg3m', 'fg3a', 'ftm', 'fta', 'oreb', 'dreb', 'reb', 'ast', 'stl', 'blk', 'turnover', 'pf', 'pts']
+
+class Payloads:
+    def __init__(self, dates_per_season, games_per_date, players_per_team, seed, live_game_seconds=0, correction_rate=0):
+        self.dates_per_season = dates_per_season
+        self.games_per_date = games_per_date
+        self.players_per_team = players_per_team
+        self.seed = seed
+        self.live_game_seconds = live_game_seconds
+        self.correction_rate = correction_rate
+        self.started = time.monotonic()
+
+    def season_dates(self, season):
+        start = datetime.date(season, 10, 20)
+        return [(start + datetime.timedelta(days=i)).isoformat() for i in range(self.dates_per_season)]
+
+    def games(self, date):
+        # Same teams, scores and ids for a date on every call
+        rng = random.Random(f"{self.seed}-{date}")
+        teams = rng.sample(TEAMS, min(2 * self.games_per_date, len(TEAMS)))
+        day = datetime.date.fromisoformat(date)
+        season = day.year if day.month >= 10 else day.year - 1
+        games = []
+        for g in range(len(teams) // 2):
+            home, visitor = teams[2 * g], teams[2 * g + 1]
+            games.append({
+                'id': int(date.replace('-', '')) * 100 + g, 'date': date, 'season': season, 'status': 'Final',
+                'period': 4, 'time': 'Final', 'postseason': day.month in (4, 5, 6) and day.day > 15,
+                'home_team_score': rng.randint(80, 140), 'visitor_team_score': rng.randint(80, 140),
+                'home_team': home, 'visitor_team': visitor,
+            })
+        return games, rng
+
+    def player(self, team, k, rng):
+        player_id = team['id'] * 1000 + k
+        return {
+            'id': player_id, 'first_name': f"First{player_id}", 'last_name': f"Last{player_id}",
+            'position': POSITIONS[player_id % len(POSITIONS)], 'height': f"6-{player_id % 12}", 'weight': str(180 + player_id % 80),
+            'jersey_number': str(k), 'college': None if k % 4 == 0 else f"College {k}", 'country': 'USA',
+            'draft_year': None if k % 5 == 0 else 2000 + k, 'draft_round': 1 + k % 2, 'draft_number': k + 1, 'team_id': team['id'],
+        }
+
+    def stat_line(self, player, rng):
+        fga, fg3a, fta = rng.randint(0, 25), rng.randint(0, 10), rng.randint(0, 12)
+        fgm = rng.randint(0, fga)
+        fg3m = rng.randint(0, min(fg3a, fgm))
+        ftm = rng.randint(0, fta)
+        oreb, dreb = rng.randint(0, 5), rng.randint(0, 10)
+        return {
+            'min': f"{rng.randint(0, 48)}:{rng.randint(0, 59):02d}", 'fgm': fgm, 'fga': fga, 'fg_pct': fgm / fga if fga else 0,
+            'fg3m': fg3m, 'fg3a': fg3a, 'fg3_pct': fg3m / fg3a if fg3a else 0, 'ftm': ftm, 'fta': fta, 'ft_pct': ftm / fta if fta else 0,
+            'oreb': oreb, 'dreb': dreb, 'reb': oreb + dreb, 'ast': rng.randint(0, 12), 'stl': rng.randint(0, 4), 'blk': rng.randint(0, 4),
+            'turnover': rng.randint(0, 6), 'pf': rng.randint(0, 6), 'pts': 2 * (fgm - fg3m) + 3 * fg3m + ftm, 'player': player,
+        }
+
+    def progress(self, date):
+        # Share of today's games played so far; every other date is final
+        if not self.live_game_seconds or date != datetime.date.today().isoformat():
+            return 1.0
+        return min((time.monotonic() - self.started) / self.live_game_seconds, 1.0)
+
+    def box_scores(self, date):
+        games, rng = self.games(date)
+        progress = self.progress(date)
+        corrections = random.Random(f"{self.seed}-{date}-corrections")
+        for game in games:
+            for side in ('home_team', 'visitor_team'):
+                team = dict(game[side])
+                team['players'] = [self.stat_line(self.player(team, k, rng), rng) for k in range(self.players_per_team)]
+                for line in team['players']:
+                    if corrections.random() < self.correction_rate:
+                        line['pts'] += 1
+                game[side] = team
+            if progress < 1.0:
+                # Final lines scaled down to the share of the game played, in whole quarters
+                quarter = int(progress * 4)
+                played = quarter / 4
+                game['status'], game['period'], game['time'] = QUARTERS[quarter], quarter + 1, '6:00'
+                game['home_team_score'] = int(game['home_team_score'] * played)
+                game['visitor_team_score'] = int(game['visitor_team_score'] * played)
+                for side in ('home_team', 'visitor_team'):
+                    for line in game[side]['players']:
+                        line.update({stat: int(line[stat] * played) for stat in COUNTING_STATS})
+        return {'data': games}
+
+    def page(self, games, cursor, per_page):
+        page = games[cursor:cursor + per_page]
+        next_cursor = cursor + per_page if cursor + per_page < len(games) else None
+        return {'data': page, 'meta': {'next_cursor': next_cursor, 'per_page': per_page}}
+
+    def games_page(self, season, cursor, per_page):
+        return self.page([game for date in self.season_dates(season) for game in self.games(date)[0]], cursor, per_page)
+
+    def box_scores_page(self, dates, cursor, per_page):
+        return self.page([game for date in dates for game in self.box_scores(date)['data']], cursor, per_page)
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.throttled = 0
+        self.latencies_ms = []
+        self.bytes = 0
+
+    def record(self, endpoint, status, elapsed, size):
+        with self.lock:
+            if status == 429:
+                self.throttled += 1
+                return
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.latencies_ms.append(elapsed * 1000)
+            self.bytes += size
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'throttled': self.throttled, 'bytes': self.bytes, 'latencies_ms': list(self.latencies_ms)}
+
+def make_handler(args, payloads, stats):
+    throttle_rng = random.Random(args.seed)
+    throttle_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        # HTTP/1.1 keeps the client's pooled connections open between requests
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+            return len(data)
+
+        def do_GET(self):
+            started = time.monotonic()
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            endpoint = url.path.rsplit('/', 1)[-1]
+
+            if url.path == '/stats':
+                self.send_json(200, stats.snapshot())
+                return
+
+            with throttle_lock:
+                throttled = throttle_rng.random() < args.rate_429
+            if throttled:
+                self.send_json(429, {'error': 'Too Many Requests'}, {'Retry-After': str(args.retry_after)})
+                stats.record(endpoint, 429, 0, 0)
+                return
+
+            if args.latency_ms or args.jitter_ms:
+                time.sleep((args.latency_ms + random.uniform(0, args.jitter_ms)) / 1000)
+
+            if url.path == '/v1/games':
+                season = int(query['seasons[]'][0])
+                cursor = int(query.get('cursor', ['0'])[0])
+                per_page = min(int(query.get('per_page', [args.page_size])[0]), args.page_size)
+                body = payloads.games_page(season, cursor, per_page)
+            elif url.path == '/v1/box_scores' and 'dates[]' in query:
+                dates = query['dates[]']
+                if not args.max_batch_dates:
+                    self.send_json(400, {'error': 'date is required'})
+                    return
+                if len(dates) > args.max_batch_dates:
+                    self.send_json(414, {'error': 'URI Too Long'})
+                    return
+                cursor = int(query.get('cursor', ['0'])[0])
+                per_page = min(int(query.get('per_page', [args.page_size])[0]), args.page_size)
+                body = payloads.box_scores_page(dates, cursor, per_page)
+            elif url.path == '/v1/box_scores':
+                body = payloads.box_scores(query['date'][0])
+            elif url.path == '/v1/teams':
+                body = {'data': TEAMS}
+            else:
+                self.send_json(404, {'error': 'Not Found'})
+                return
+            size = self.send_json(200, body)
+            stats.record(endpoint, 200, time.monotonic() - started, size)
+
+    return Handler
+
+def main():
+    args = parse_args()
+    payloads = Payloads(args.dates_per_season, args.games_per_date, args.players_per_team, args.seed, args.live_game_seconds, args.correction_rate)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(args, payloads, Stats()))
+    server.daemon_threads = True
+    print(f"Serving fake API on http://127.0.0.1:{args.port}/v1", flush=True)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
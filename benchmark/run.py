@@ -0,0 +1,145 @@
+import argparse
+import datetime
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import numpy as np
+
+# Runs box_score/main.py end to end against fake_api.py and appends one line of results to results.jsonl:
+#   python benchmark/run.py --start_year 2001 --end_year 2002 --backend duckdb -- --engine async
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOX_SCORE_DIR = os.path.join(ROOT, 'db_manager', 'box_score')
+RESULTS = os.path.join(ROOT, 'benchmark', 'results.jsonl')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end ingest benchmark against the fake API")
+    parser.add_argument('--start_year', type=int, default=2001, help='First season ingested')
+    parser.add_argument('--end_year', type=int, default=2001, help='Last season ingested')
+    parser.add_argument('--backend', choices=['duckdb', 'postgres'], default='duckdb', help='duckdb uses a throwaway file, postgres the database in .env')
+    parser.add_argument('--latency_ms', type=float, default=20, help='Fake API latency per request')
+    parser.add_argument('--jitter_ms', type=float, default=10, help='Fake API latency jitter')
+    parser.add_argument('--page_size', type=int, default=100, help='Fake API games page size')
+    parser.add_argument('--rate_429', type=float, default=0, help='Fraction of requests the fake API throttles')
+    parser.add_argument('--dates_per_season', type=int, default=160, help='Game dates per season')
+    parser.add_argument('--games_per_date', type=int, default=8, help='Games per date')
+    parser.add_argument('--max_batch_dates', type=int, default=0, help='Most dates the fake API serves per box_scores request, 0 for single dates only')
+    parser.add_argument('--batch_dates', type=int, default=1, help='API_BATCH_DATES for the ingest')
+    parser.add_argument('--rate_limit', type=float, default=60000, help='RATE_LIMIT_PER_MINUTE for the ingest')
+    parser.add_argument('--label', default='', help='Free-form note stored with the results')
+    parser.add_argument('--output', default=RESULTS, help='Results file, one JSON object per run')
+    parser.add_argument('main_args', nargs=argparse.REMAINDER, help='Extra main.py arguments after --')
+    return parser.parse_args()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_fake_api(args, port):
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmark', 'fake_api.py'), '--port', str(port),
+                               '--latency_ms', str(args.latency_ms), '--jitter_ms', str(args.jitter_ms),
+                               '--page_size', str(args.page_size), '--rate_429', str(args.rate_429),
+                               '--dates_per_season', str(args.dates_per_season), '--games_per_date', str(args.games_per_date),
+                               '--max_batch_dates', str(args.max_batch_dates)],
+                              stdout=subprocess.PIPE, text=True)
+    server.stdout.readline()  # Wait for the server to listen
+    return server
+
+def fetch_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.load(response)
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def run_ingest(args, port, workdir):
+    env = dict(os.environ,
+               API_BASE=f"http://127.0.0.1:{port}/v1", API_KEY='benchmark',
+               RATE_LIMIT_PER_MINUTE=str(args.rate_limit), RATE_LIMIT_STATE='', API_BATCH_DATES=str(args.batch_dates),
+               CACHE_DIR=os.path.join(workdir, 'cache'), CURSOR_STATE=os.path.join(workdir, 'cursors.json'),
+               DB_BACKEND=args.backend, DUCKDB_PATH=os.path.join(workdir, 'box_scores.duckdb'))
+    command = [sys.executable, 'main.py', '--start_year', str(args.start_year), '--end_year', str(args.end_year)]
+    command += [arg for arg in args.main_args if arg != '--']
+
+    # os.wait4 reports the child's own peak RSS, which Popen.wait would discard
+    with open(os.path.join(workdir, 'main.log'), 'w+') as log:
+        started = time.monotonic()
+        process = subprocess.Popen(command, cwd=BOX_SCORE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.monotonic() - started
+        process.returncode = os.waitstatus_to_exitcode(status)
+        log.seek(0)
+        output = log.read()
+    return elapsed, usage.ru_maxrss * 1024, process.returncode, output
+
+def rows_loaded(output):
+    # "Rows inserted/skipped: player: +12/3 skipped, ..." counts every row the writers handled
+    match = re.search(r"Rows inserted/skipped: (.*)", output)
+    if not match:
+        return None
+    return sum(int(inserted) + int(skipped) for inserted, skipped in re.findall(r"\+(\d+)/(\d+) skipped", match.group(1)))
+
+def dates_parsed(output):
+    # "Dates: parsed: 160, written: 160" from the metrics summary
+    match = re.search(r"Dates: .*?parsed: (\d+)", output)
+    return int(match.group(1)) if match else 0
+
+def main():
+    args = parse_args()
+    port = free_port()
+    server = start_fake_api(args, port)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            elapsed, peak_rss, returncode, output = run_ingest(args, port, workdir)
+        stats = fetch_stats(port)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if returncode != 0:
+        print(output)
+        raise SystemExit(f"main.py exited with {returncode}")
+
+    # Packed requests serve several dates each, so dates are counted by the ingest
+    dates = dates_parsed(output)
+    rows = rows_loaded(output)
+    latencies = np.array(stats['latencies_ms'] or [0.0])
+    result = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'label': args.label,
+        'backend': args.backend,
+        'seasons': [args.start_year, args.end_year],
+        'main_args': [arg for arg in args.main_args if arg != '--'],
+        'fake_api': {'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms, 'page_size': args.page_size,
+                     'rate_429': args.rate_429, 'dates_per_season': args.dates_per_season, 'games_per_date': args.games_per_date,
+                     'max_batch_dates': args.max_batch_dates},
+        'batch_dates': args.batch_dates,
+        'seconds': round(elapsed, 3),
+        'dates': dates,
+        'rows': rows,
+        'dates_per_sec': round(dates / elapsed, 2),
+        'rows_per_sec': round(rows / elapsed, 1) if rows is not None else None,
+        'requests': sum(stats['requests'].values()),
+        'box_score_requests': stats['requests'].get('box_scores', 0),
+        'throttled': stats['throttled'],
+        'latency_p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'latency_p99_ms': round(float(np.percentile(latencies, 99)), 2),
+        'peak_rss_mb': round(peak_rss / 1024 ** 2, 1),
+    }
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    print(json.dumps(result, indent=2))
+
+if __name__ == '__main__':
+    main()
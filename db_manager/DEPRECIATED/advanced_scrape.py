@@ -1,4 +1,5 @@
 import os
+import sys
 from dotenv import load_dotenv
 import requests
 import psycopg2
@@ -6,17 +7,17 @@ from tqdm import tqdm
 from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
 import numpy as np
 
+# Share the box_score HTTP client so requests reuse its pool and rate limit
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'box_score'))
+from rate_limit import wait_for_limiter
+import client
+from paginate import paginate_seasons
+
 # Take environment variables from .env.
 load_dotenv()
 
 # API Configuration
-API_KEY = os.getenv("API_KEY")
-API_ENDPOINT = "https://api.balldontlie.io/v1/stats/advanced"
-
-# Set up the headers with the API key.
-headers = {
-    'Authorization': API_KEY
-}
+API_ENDPOINT = "stats/advanced"
 
 # Database connection details
 conn_str = (f"dbname=nba_stats user={os.getenv('DB_USER')} " +
@@ -54,14 +55,13 @@ INSERT INTO player_game (
 ON CONFLICT (player_id, game_id) DO NOTHING;
 """
 
-@retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(5), retry=retry_if_exception_type(requests.exceptions.RequestException))
+@retry(wait=wait_for_limiter(wait_exponential(multiplier=1, min=4, max=10)), stop=stop_after_attempt(5), retry=retry_if_exception_type(requests.exceptions.RequestException))
 def make_request(params):
-    response = requests.get(API_ENDPOINT, headers=headers, params=params)
+    response = client.get(API_ENDPOINT, params)
     response.raise_for_status()  # Raise an exception for HTTP errors
     return response
 
-def fetch_data(season):
-    cur_cursor = None
+def fetch_data(season, cur_cursor=None):
     while True:
         params = {
             "seasons[]": season,
@@ -72,8 +72,8 @@ def fetch_data(season):
         try:
             response = make_request(params)
             data = response.json()
-            yield data['data'], len(response.content)
             cur_cursor = data['meta'].get('next_cursor', None)
+            yield data['data'], len(response.content), cur_cursor
             if not cur_cursor:
                 break
         except requests.exceptions.HTTPError as e:
@@ -85,42 +85,45 @@ def fetch_data(season):
 
 # Function to fetch data from the API and insert into PostgreSQL
 def fetch_and_store_data(seasons):
-    for season in tqdm(seasons, desc="Seasons", unit="season"):
-        data_generator = fetch_data(season)
-        for data_page, data_size in tqdm(data_generator, desc=f"Season {season}", unit="page", leave=False):
-            total_bytes += data_size
-            for record in data_page:
-                player = record.pop('player')
-                game = record.pop('game')
-
-                # Insert into player table
-                cursor.execute(player_insert_query, (
-                    player['id'], player['first_name'], player['last_name'], player.get('position', None), 
-                    player.get('height', None), player.get('weight', None), player.get('jersey_number', None), 
-                    player.get('college', None), player.get('country', None), player.get('draft_year', None), 
-                    player.get('draft_round', None), player.get('draft_number', None), player.get('team_id', None)
-                ))
-
-                # Insert into game table
-                cursor.execute(game_insert_query, (
-                    game['id'], game['date'], game['season'], game['postseason'], 
-                    game['home_team_score'], game['visitor_team_score'], 
-                    game['home_team_id'], game['visitor_team_id']
-                ))
-
-                # Insert into player_game table
-                cursor.execute(player_game_insert_query, (
-                    player['id'], game['id'], 
-                    record.get('pie', None), record.get('pace', None), 
-                    record.get('assist_percentage', None), record.get('assist_ratio', None), 
-                    record.get('assist_to_turnover', None), record.get('defensive_rating', None), 
-                    record.get('defensive_rebound_percentage', None), record.get('effective_field_goal_percentage', None), 
-                    record.get('net_rating', None), record.get('offensive_rating', None), 
-                    record.get('offensive_rebound_percentage', None), record.get('true_shooting_percentage', None), 
-                    record.get('turnover_ratio', None), record.get('usage_percentage', None)
-                ))
-
-            conn.commit()
+    total_bytes = 0
+    # One cursor chain per season runs concurrently; pages arrive as each season produces them
+    data_generator = paginate_seasons(fetch_data, API_ENDPOINT, seasons)
+    for data_page, data_size, ack in tqdm(data_generator, desc="Pages", unit="page"):
+        total_bytes += data_size
+        for record in data_page:
+            player = record.pop('player')
+            game = record.pop('game')
+
+            # Insert into player table
+            cursor.execute(player_insert_query, (
+                player['id'], player['first_name'], player['last_name'], player.get('position', None), 
+                player.get('height', None), player.get('weight', None), player.get('jersey_number', None), 
+                player.get('college', None), player.get('country', None), player.get('draft_year', None), 
+                player.get('draft_round', None), player.get('draft_number', None), player.get('team_id', None)
+            ))
+
+            # Insert into game table
+            cursor.execute(game_insert_query, (
+                game['id'], game['date'], game['season'], game['postseason'], 
+                game['home_team_score'], game['visitor_team_score'], 
+                game['home_team_id'], game['visitor_team_id']
+            ))
+
+            # Insert into player_game table
+            cursor.execute(player_game_insert_query, (
+                player['id'], game['id'], 
+                record.get('pie', None), record.get('pace', None), 
+                record.get('assist_percentage', None), record.get('assist_ratio', None), 
+                record.get('assist_to_turnover', None), record.get('defensive_rating', None), 
+                record.get('defensive_rebound_percentage', None), record.get('effective_field_goal_percentage', None), 
+                record.get('net_rating', None), record.get('offensive_rating', None), 
+                record.get('offensive_rebound_percentage', None), record.get('true_shooting_percentage', None), 
+                record.get('turnover_ratio', None), record.get('usage_percentage', None)
+            ))
+
+        conn.commit()
+        # The page is stored, so a resumed run can start past it
+        ack()
 
 # List of seasons to fetch data for
 seasons = np.arange(2014, 2023)
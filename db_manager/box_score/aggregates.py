@@ -0,0 +1,151 @@
+import argparse
+import csv
+import os
+import database
+
+# player_game columns averaged per game and then per season by query.sql
+STATS = ['fgm', 'fga', 'fg3m', 'fg3a', 'ftm', 'fta', 'reb', 'ast', 'stl', 'blk', 'turnover', 'pf', 'pts']
+SCORES = ['home_team_score', 'visitor_team_score']
+
+QUERY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'query.sql')
+OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'yearly_avg.csv')
+
+# Per-game sums and non-null counts, so each per-game AVG is exactly sum / count
+game_columns = ['game_id', 'season'] + SCORES + [f"{stat}_{part}" for stat in STATS for part in ('sum', 'count')]
+game_select = ', '.join(['game.game_id', 'game.season'] + [f"game.{score}" for score in SCORES] +
+                        [f"SUM(player_game.{stat}), COUNT(player_game.{stat})" for stat in STATS])
+
+refresh_games_query = f"""
+INSERT INTO game_aggregate ({', '.join(game_columns)})
+SELECT {game_select}
+FROM game
+INNER JOIN player_game ON game.game_id = player_game.game_id
+WHERE game.game_id = ANY(%s)
+GROUP BY game.game_id, game.season, {', '.join(f'game.{score}' for score in SCORES)}
+ON CONFLICT (game_id) DO UPDATE SET
+    ({', '.join(game_columns[1:])}, updated_at) = ({', '.join(f'EXCLUDED.{column}' for column in game_columns[1:])}, now())
+RETURNING season;
+"""
+
+# Per-season sums of the per-game averages, matching query.sql's AVG over games
+season_columns = ['season', 'games'] + [f"{column}_{part}" for column in SCORES + STATS for part in ('sum', 'count')]
+season_select = ', '.join(['season', 'COUNT(*)'] + [f"SUM({score}), COUNT({score})" for score in SCORES] +
+                          [f"SUM({stat}_sum::numeric / NULLIF({stat}_count, 0)), COUNT(NULLIF({stat}_count, 0))" for stat in STATS])
+
+refresh_seasons_query = f"""
+INSERT INTO season_aggregate ({', '.join(season_columns)})
+SELECT {season_select}
+FROM game_aggregate
+WHERE season = ANY(%s)
+GROUP BY season
+ON CONFLICT (season) DO UPDATE SET
+    ({', '.join(season_columns[1:])}, updated_at) = ({', '.join(f'EXCLUDED.{column}' for column in season_columns[1:])}, now());
+"""
+
+# Writers refreshing the same season take turns, so each recompute sees the others' committed games
+lock_seasons_query = """
+SELECT pg_advisory_xact_lock(hashtext('season_aggregate'), season)
+FROM unnest(%s::int[]) AS season
+ORDER BY season;
+"""
+
+yearly_query = f"""
+SELECT season,
+    {', '.join(f'{score}_sum::numeric / NULLIF({score}_count, 0) AS avg_{score}' for score in SCORES)},
+    {', '.join(f'{stat}_sum / NULLIF({stat}_count, 0) AS avg_{stat}' for stat in STATS)}
+FROM season_aggregate
+ORDER BY season;
+"""
+
+output_columns = ['season'] + [f"avg_{column}" for column in SCORES + STATS]
+
+def available(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('game_aggregate') IS NOT NULL AND to_regclass('season_aggregate') IS NOT NULL;")
+        return cur.fetchone()[0]
+
+def refresh(cursor, game_ids):
+    # Recompute the touched games from player_game, then the seasons they belong to from game_aggregate
+    game_ids = sorted(set(game_ids))
+    if not game_ids:
+        return
+    cursor.execute(refresh_games_query, [game_ids])
+    seasons = sorted({season for (season,) in cursor.fetchall()})
+    if seasons:
+        cursor.execute(lock_seasons_query, [seasons])
+        cursor.execute(refresh_seasons_query, [seasons])
+
+def rebuild(conn):
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE game_aggregate, season_aggregate;")
+        cur.execute(refresh_games_query.replace("WHERE game.game_id = ANY(%s)", ""))
+        seasons = sorted({season for (season,) in cur.fetchall()})
+        cur.execute(refresh_seasons_query, [seasons])
+    conn.commit()
+    return len(seasons)
+
+def yearly(conn):
+    # Embedded backends keep no aggregate tables; their vectorized engine runs query.sql directly instead
+    if not database.get_backend().derived_tables:
+        return recompute(conn)
+    with conn.cursor() as cur:
+        cur.execute(yearly_query)
+        return cur.fetchall()
+
+def recompute(conn):
+    with open(QUERY_PATH) as f:
+        query = f.read()
+    with conn.cursor() as cur:
+        cur.execute(query)
+        return cur.fetchall()
+
+def verify(conn):
+    # Every season and column must match a full run of query.sql exactly
+    expected = {row[0]: row for row in recompute(conn)}
+    actual = {row[0]: row for row in yearly(conn)}
+    mismatches = []
+    for season in sorted(expected.keys() | actual.keys()):
+        if season not in actual or season not in expected:
+            mismatches.append((season, 'season', expected.get(season), actual.get(season)))
+            continue
+        for column, want, got in zip(output_columns, expected[season], actual[season]):
+            if want != got:
+                mismatches.append((season, column, want, got))
+    return len(expected), mismatches
+
+def export(conn, path):
+    rows = yearly(conn)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(output_columns)
+        # Averages are quoted like the psql export in data/yearly_avg.csv
+        writer.writerows([season] + ['' if value is None else str(value) for value in values] for season, *values in rows)
+    return len(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the season aggregate tables")
+    parser.add_argument('command', choices=['rebuild', 'verify', 'export'], help='Rebuild from player_game, diff against query.sql, or write the yearly averages')
+    parser.add_argument('--output', default=OUTPUT_PATH, help='Where export writes the yearly averages')
+    args = parser.parse_args()
+
+    if args.command != 'export' and not database.get_backend().derived_tables:
+        raise SystemExit(f"The {database.backend_name} backend computes yearly averages from query.sql, there is nothing to {args.command}")
+
+    conn = database.connect()
+    try:
+        if args.command == 'rebuild':
+            print(f"Rebuilt aggregates for {rebuild(conn)} seasons")
+        elif args.command == 'verify':
+            num_seasons, mismatches = verify(conn)
+            for season, column, want, got in mismatches:
+                print(f"Season {season} {column}: query.sql {want} != aggregate {got}")
+            print(f"Checked {num_seasons} seasons, {len(mismatches)} mismatches")
+            if mismatches:
+                raise SystemExit(1)
+        else:
+            print(f"Wrote {export(conn, args.output)} seasons to {args.output}")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,138 @@
+import json
 import os
 import requests
 from dotenv import load_dotenv
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
+from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type, retry_if_exception
+from tqdm import tqdm
+from rate_limit import wait_for_limiter
+import client
+import cache
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
 
 # API Configuration
-API_KEY = os.getenv("API_KEY")
-API_ENDPOINT = "https://api.balldontlie.io/v1/box_scores"
+API_ENDPOINT = "box_scores"
 
-# Set up the headers with the API key
-headers = {
-    'Authorization': API_KEY
-}
+# Dates packed into one box_scores request as dates[]; 1 asks for each date on its own with date=,
+# the only form the public endpoint accepts
+BATCH_DATES = int(os.getenv("API_BATCH_DATES", 1))
 
-@retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(5), retry=retry_if_exception_type(requests.exceptions.RequestException))
-def make_request(params):
-    response = requests.get(API_ENDPOINT, headers=headers, params=params)
+# Games per page of a packed request, the API's largest page
+BATCH_PAGE_SIZE = 100
+
+# Statuses of a request the server refuses as too large, answered by splitting the batch
+SPLIT_STATUSES = (400, 413, 414)
+
+# Largest batch to send, lowered whenever the server refuses one as too large
+batch_limit = BATCH_DATES
+
+def too_large(exception):
+    return isinstance(exception, requests.exceptions.HTTPError) and exception.response is not None \
+        and exception.response.status_code in SPLIT_STATUSES
+
+def retryable(exception):
+    return isinstance(exception, requests.exceptions.RequestException) and not too_large(exception)
+
+@retry(wait=wait_for_limiter(wait_exponential(multiplier=1, min=4, max=10)), stop=stop_after_attempt(5), retry=retry_if_exception_type(requests.exceptions.RequestException), before_sleep=metrics.count_retry(API_ENDPOINT))
+def fetch_box_scores(params):
+    response = client.get(API_ENDPOINT, params)
+    response.raise_for_status()  # Raise an exception for HTTP errors
+    return response.content
+
+@retry(wait=wait_for_limiter(wait_exponential(multiplier=1, min=4, max=10)), stop=stop_after_attempt(5), retry=retry_if_exception(retryable), before_sleep=metrics.count_retry(API_ENDPOINT))
+def fetch_batch_page(params):
+    response = client.get(API_ENDPOINT, params)
     response.raise_for_status()  # Raise an exception for HTTP errors
-    return response.json()
+    return response.content
+
+def fetch_raw(params):
+    return cache.get_or_fetch(API_ENDPOINT, params, fetch_box_scores)
+
+def fetch_fresh(params):
+    # Skips the cache for a payload that may have changed since it was stored, refreshing the cached copy
+    body = fetch_box_scores(params)
+    cache.store(API_ENDPOINT, params, body)
+    return body
+
+def make_request(params):
+    return json.loads(fetch_raw(params))
+
+def batch_params(dates, cursor=None):
+    # A list of pairs, so dates[] repeats once per date
+    params = [("dates[]", date) for date in dates] + [("per_page", BATCH_PAGE_SIZE)]
+    return params if cursor is None else params + [("cursor", cursor)]
+
+def route(dates, games):
+    # One payload per requested date, shaped and cached like its date= response, so parsing, hashing
+    # and replay see no difference
+    by_date = {date: [] for date in dates}
+    for game in games:
+        day = game['date'][:10]
+        if day in by_date:
+            by_date[day].append(game)
+    bodies = {}
+    for date, day_games in by_date.items():
+        bodies[date] = json.dumps({'data': day_games}).encode()
+        cache.store(API_ENDPOINT, {"date": date}, bodies[date])
+    return bodies
+
+def fetch_batch(dates):
+    # Every game of the given dates, following the cursor across pages
+    games = []
+    cursor = None
+    while True:
+        data = json.loads(fetch_batch_page(batch_params(dates, cursor)))
+        games.extend(data['data'])
+        cursor = data.get('meta', {}).get('next_cursor')
+        if not cursor:
+            return games
+
+def refused(dates, status):
+    # Halves the batch limit below a refused batch, so later batches fit the server without a refusal each
+    global batch_limit
+    metrics.batch_splits.inc(endpoint=API_ENDPOINT)
+    if len(dates) // 2 < batch_limit:
+        batch_limit = max(len(dates) // 2, 1)
+        tqdm.write(f"{API_ENDPOINT} refused {len(dates)} dates with {status}, sending at most {batch_limit}")
+
+def fetch_split(dates):
+    # {date: payload, or the exception that failed it}; a batch refused as too large is split in half
+    # until it fits, and a single date is asked for with date=
+    if len(dates) == 1:
+        try:
+            return {dates[0]: fetch_fresh({"date": dates[0]})}
+        except Exception as e:
+            return {dates[0]: e}
+    try:
+        return route(dates, fetch_batch(dates))
+    except Exception as e:
+        if not too_large(e):
+            return {date: e for date in dates}
+        refused(dates, e.response.status_code)
+        half = len(dates) // 2
+        return {**fetch_split(dates[:half]), **fetch_split(dates[half:])}
+
+def plan(dates):
+    # Cached payloads, the dates still to fetch, and a CacheMiss for each uncached date in replay mode
+    bodies = {}
+    missing = []
+    for date in dates:
+        body = cache.lookup(API_ENDPOINT, {"date": date})
+        if body is not None:
+            bodies[date] = body
+        elif cache.replay:
+            bodies[date] = cache.CacheMiss(f"No cached payload for {API_ENDPOINT} {date}")
+        else:
+            missing.append(date)
+    return bodies, missing
+
+def fetch_dates(dates):
+    # Payloads of several dates in as few requests as the server allows: cached dates are read from
+    # the cache and the rest are packed batch_limit to a request
+    bodies, missing = plan(dates)
+    while missing:
+        batch, missing = missing[:batch_limit], missing[batch_limit:]
+        bodies.update(fetch_split(batch))
+    return bodies
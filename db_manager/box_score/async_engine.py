@@ -0,0 +1,181 @@
+import asyncio
+import json
+import time
+import aiohttp
+import api
+from api import API_ENDPOINT, SPLIT_STATUSES
+import client
+import cache
+import metrics
+import process
+from process import parse_payload, record_failure, unchanged
+from dead_letter import dead_letters
+from writer import start_writers, stop_writers
+from rate_limit import limiter, THROTTLE_STATUSES
+
+async def fetch_date(session, date, attempts=5):
+    params = {
+        "date": date,
+    }
+    body = cache.lookup(API_ENDPOINT, params)
+    if body is not None:
+        return body
+    if cache.replay:
+        raise cache.CacheMiss(f"No cached payload for {API_ENDPOINT} {params}")
+    body = await request(session, params, attempts)
+    cache.store(API_ENDPOINT, params, body)
+    return body
+
+async def request(session, params, attempts=5, split=False):
+    # With split, a refusal as too large is raised at once for the caller to split the batch
+    for attempt in range(attempts):
+        metrics.limiter_wait_seconds.observe(await limiter.acquire_async())
+        started = time.monotonic()
+        try:
+            async with session.get(client.url(API_ENDPOINT), params=params) as response:
+                metrics.responses.inc(endpoint=API_ENDPOINT, status=response.status)
+                await limiter.observe_async(response.status, response.headers)
+                response.raise_for_status()  # Raise an exception for HTTP errors
+                body = await response.read()
+                metrics.request_seconds.observe(time.monotonic() - started, endpoint=API_ENDPOINT)
+                metrics.downloaded_bytes.inc(len(body), endpoint=API_ENDPOINT)
+                return body
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.request_seconds.observe(time.monotonic() - started, endpoint=API_ENDPOINT)
+            if not isinstance(e, aiohttp.ClientResponseError):
+                metrics.responses.inc(endpoint=API_ENDPOINT, status='error')
+            if attempt == attempts - 1 or (split and too_large(e)):
+                raise
+            metrics.retries.inc(endpoint=API_ENDPOINT)
+            # Throttled requests wait on the shared limiter instead of backing off alone
+            if not (isinstance(e, aiohttp.ClientResponseError) and e.status in THROTTLE_STATUSES):
+                await asyncio.sleep(min(4 * 2 ** attempt, 10))
+
+def too_large(exception):
+    return isinstance(exception, aiohttp.ClientResponseError) and exception.status in SPLIT_STATUSES
+
+async def fetch_batch(session, dates):
+    # Every game of the given dates, following the cursor across pages
+    games = []
+    cursor = None
+    while True:
+        data = json.loads(await request(session, api.batch_params(dates, cursor), split=True))
+        games.extend(data['data'])
+        cursor = data.get('meta', {}).get('next_cursor')
+        if not cursor:
+            return games
+
+async def fetch_split(session, dates):
+    # Same splitting as api.fetch_split, on the event loop
+    if len(dates) == 1:
+        try:
+            body = await request(session, {"date": dates[0]})
+            cache.store(API_ENDPOINT, {"date": dates[0]}, body)
+            return {dates[0]: body}
+        except Exception as e:
+            return {dates[0]: e}
+    try:
+        return api.route(dates, await fetch_batch(session, dates))
+    except Exception as e:
+        if not too_large(e):
+            return {date: e for date in dates}
+        api.refused(dates, e.status)
+        half = len(dates) // 2
+        return {**await fetch_split(session, dates[:half]), **await fetch_split(session, dates[half:])}
+
+async def fetch_dates(session, dates):
+    bodies, missing = api.plan(dates)
+    while missing:
+        batch, missing = missing[:api.batch_limit], missing[api.batch_limit:]
+        bodies.update(await fetch_split(session, batch))
+    return bodies
+
+async def process_date_async(session, date, body=None):
+    # body is the date's payload or the exception that failed its fetch, None to fetch it here
+    stage = 'fetch'
+    try:
+        if body is None:
+            body = await fetch_date(session, date)
+        if isinstance(body, Exception):
+            raise body
+        metrics.payload_bytes.inc(len(body), endpoint=API_ENDPOINT)
+        stage = 'parse'
+        with metrics.parse_seconds.time():
+            if process.parse_pool is None:
+                records, digest = parse_payload(body)
+            else:
+                # Keeps the event loop free to drive requests while a parse process decodes
+                records, digest = await asyncio.get_running_loop().run_in_executor(process.parse_pool, parse_payload, body)
+        metrics.dates.inc(outcome='parsed')
+        return date, records, digest
+    except Exception as e:
+        # Recorded off the event loop, since it is a database round trip
+        await asyncio.get_running_loop().run_in_executor(None, record_failure, date, stage, e)
+        return date, None, None
+
+# Seconds the feed waits for more dates to fill a packed request before sending a partial one
+BATCH_LINGER = 0.05
+
+async def run_async(dates, progress_bar, writer_options, concurrency=200):
+    loop = asyncio.get_running_loop()
+    date_queue = asyncio.Queue(maxsize=concurrency * 2)
+    dates = iter(dates)
+
+    async def feed():
+        # Pull discovered dates off the (blocking) discovery generator without stalling the loop, grouped
+        # into batches of up to api.batch_limit dates for packed requests. Idle consumers would each take
+        # a lone date, so the feed groups them: a partial batch goes out once no date came for BATCH_LINGER.
+        pending = None
+        batch = []
+        try:
+            while True:
+                if pending is None:
+                    pending = loop.run_in_executor(None, next, dates, None)
+                # A timed out wait leaves the pending next() running for the following round
+                done, _ = await asyncio.wait({pending}, timeout=BATCH_LINGER if batch else None)
+                if done:
+                    date, pending = pending.result(), None
+                    if date is None:
+                        break
+                    progress_bar.total += 1
+                    progress_bar.refresh()
+                    batch.append(date)
+                    if len(batch) < api.batch_limit:
+                        continue
+                await date_queue.put(batch)
+                batch = []
+            if batch:
+                await date_queue.put(batch)
+        finally:
+            for _ in range(concurrency):
+                await date_queue.put(None)
+
+    async def consume(session):
+        # Each consumer keeps one request in flight, so concurrency consumers bound the total
+        while (dates := await date_queue.get()) is not None:
+            if len(dates) > 1:
+                bodies = await fetch_dates(session, dates)
+                results = [await process_date_async(session, date, bodies[date]) for date in dates]
+            else:
+                results = [await process_date_async(session, date) for date in dates]
+            for date, records, digest in results:
+                if records is not None and not unchanged(date, digest):
+                    # Waits in a helper thread so a full write queue slows parsing without blocking the loop
+                    with metrics.queue_wait_seconds.time(queue='write'):
+                        await loop.run_in_executor(None, write_queue.put, (date, records, digest))
+                elif records is not None:
+                    metrics.dates.inc(outcome='unchanged')
+                    dead_letters.settle([date])
+                progress_bar.update(1)
+
+    write_queue, writers = start_writers(**writer_options)
+    metrics.queue_depth.track(date_queue.qsize, queue='dates')
+    try:
+        async with client.async_session(concurrency) as session:
+            await asyncio.gather(feed(), *(consume(session) for _ in range(concurrency)))
+    finally:
+        metrics.queue_depth.untrack(queue='dates')
+        await loop.run_in_executor(None, stop_writers, write_queue, writers)
+
+def run(dates, progress_bar, writer_options, concurrency=200):
+    asyncio.run(run_async(dates, progress_bar, writer_options, concurrency))
@@ -0,0 +1,127 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import time
+from threading import Lock, get_ident
+from dotenv import load_dotenv
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Cache configuration
+CACHE_DIR = os.getenv("CACHE_DIR", ".cache")
+CACHE_TTL = float(os.getenv("CACHE_TTL", 6 * 60 * 60))  # Seconds before current-season payloads are refetched
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# In replay mode every payload must come from the cache
+replay = False
+
+# In refetch mode every payload is fetched again and replaces the cached copy, e.g. to pick up stat corrections
+refetch = False
+
+size_lock = Lock()
+total_size = None
+
+class CacheMiss(Exception):
+    pass
+
+def season_of(date):
+    # NBA seasons are named after the year they start in, which is October
+    return date.year if date.month >= 10 else date.year - 1
+
+def season_bounds(seasons):
+    # First and last day of a range of seasons
+    return datetime.date(min(seasons), 10, 1), datetime.date(max(seasons) + 1, 9, 30)
+
+def is_current_season(params):
+    current = season_of(datetime.date.today())
+    if "date" in params:
+        return season_of(datetime.date.fromisoformat(str(params["date"]))) >= current
+    if "seasons[]" in params:
+        return int(params["seasons[]"]) >= current
+    return True
+
+def make_key(endpoint, params):
+    canonical = json.dumps([endpoint, sorted((k, str(v)) for k, v in (params or {}).items())])
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def path_for(key):
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.gz")
+
+def lookup(endpoint, params):
+    path = path_for(make_key(endpoint, params))
+    if refetch:
+        metrics.cache_lookups.inc(endpoint=endpoint, result='stale')
+        return None
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        metrics.cache_lookups.inc(endpoint=endpoint, result='miss')
+        return None
+    if not replay and is_current_season(params) and time.time() - stat.st_mtime > CACHE_TTL:
+        metrics.cache_lookups.inc(endpoint=endpoint, result='stale')
+        return None
+    with gzip.open(path, "rb") as f:
+        body = f.read()
+    os.utime(path, (time.time(), stat.st_mtime))  # Track access time for eviction
+    metrics.cache_lookups.inc(endpoint=endpoint, result='hit')
+    return body
+
+def store(endpoint, params, body):
+    path = path_for(make_key(endpoint, params))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique per thread, as threads fetching the same key would otherwise write one temp file
+    tmp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    with gzip.open(tmp_path, "wb") as f:
+        f.write(body)
+    new_size = os.path.getsize(tmp_path)
+    with size_lock:
+        # A rewritten key replaces its old file, so only the difference counts towards the budget
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp_path, path)
+    track_size(new_size - old_size)
+
+def get_or_fetch(endpoint, params, fetch):
+    body = lookup(endpoint, params)
+    if body is not None:
+        return body
+    if replay:
+        raise CacheMiss(f"No cached payload for {endpoint} {params}")
+    body = fetch(params)
+    store(endpoint, params, body)
+    return body
+
+def entries():
+    for root, _, files in os.walk(CACHE_DIR):
+        for name in files:
+            if name.endswith(".gz"):
+                path = os.path.join(root, name)
+                yield path, os.stat(path)
+
+def track_size(added):
+    global total_size
+    with size_lock:
+        if total_size is None:
+            total_size = sum(stat.st_size for _, stat in entries())
+        else:
+            total_size += added
+        if total_size > CACHE_MAX_BYTES:
+            evict()
+
+def evict():
+    # Drop least recently used payloads until the cache is back to 90% of its budget
+    global total_size
+    for path, stat in sorted(entries(), key=lambda entry: entry[1].st_atime):
+        if total_size <= CACHE_MAX_BYTES * 0.9:
+            break
+        try:
+            os.remove(path)
+            total_size -= stat.st_size
+        except FileNotFoundError:
+            pass
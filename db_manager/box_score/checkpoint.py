@@ -0,0 +1,77 @@
+import database
+
+# Per-date ingest state: pending -> [leased ->] done | failed; distributed workers lease dates before loading them.
+# attempts counts failed tries over the date's lifetime, while dead_letter.attempts drives its retries.
+register_query = """
+INSERT INTO ingest_checkpoint (date, status)
+VALUES %s
+ON CONFLICT (date) DO NOTHING;
+"""
+
+done_query = """
+INSERT INTO ingest_checkpoint (date, status, payload_hash, attempts, updated_at)
+VALUES %s
+ON CONFLICT (date) DO UPDATE SET
+    status = 'done',
+    payload_hash = {payload_hash},
+    updated_at = now(),
+    leased_by = NULL,
+    lease_until = NULL;
+"""
+
+# Without merge, rows already stored are left as they were, so a date keeps the hash of the payload
+# its rows came from and a later --merge still sees the newer payload as changed
+kept_hash = "COALESCE(ingest_checkpoint.payload_hash, EXCLUDED.payload_hash)"
+
+failed_query = """
+INSERT INTO ingest_checkpoint (date, status, attempts, updated_at)
+VALUES %s
+ON CONFLICT (date) DO UPDATE SET
+    status = 'failed',
+    attempts = ingest_checkpoint.attempts + 1,
+    updated_at = now(),
+    leased_by = NULL,
+    lease_until = NULL;
+"""
+
+# Dates around today can still change, so they are never treated as loaded
+loaded_query = """
+SELECT date, payload_hash
+FROM ingest_checkpoint
+WHERE status = 'done' AND date < current_date - 1;
+"""
+
+unfinished_query = """
+SELECT date
+FROM ingest_checkpoint
+WHERE status <> 'done' OR date >= current_date - 1
+ORDER BY date;
+"""
+
+def register(conn, dates):
+    with conn.cursor() as cur:
+        database.execute_values(cur, register_query, [(str(date), 'pending') for date in dates])
+    conn.commit()
+
+def mark_done(conn, results):
+    # Runs inside the writer's transaction so data and checkpoint commit together
+    with conn.cursor() as cur:
+        payload_hash = "EXCLUDED.payload_hash" if database.merge_enabled() else kept_hash
+        database.execute_values(cur, done_query.format(payload_hash=payload_hash), [(str(date), 'done', payload_hash, 0) for date, payload_hash in results],
+                       template="(%s, %s, %s, %s, now())")
+
+def mark_failed(conn, dates):
+    with conn.cursor() as cur:
+        database.execute_values(cur, failed_query, [(str(date), 'failed', 1) for date in dates],
+                       template="(%s, %s, %s, now())")
+    conn.commit()
+
+def loaded(conn):
+    with conn.cursor() as cur:
+        cur.execute(loaded_query)
+        return {date.isoformat(): payload_hash for date, payload_hash in cur.fetchall()}
+
+def unfinished(conn):
+    with conn.cursor() as cur:
+        cur.execute(unfinished_query)
+        return [date.isoformat() for (date,) in cur.fetchall()]
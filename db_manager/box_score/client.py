@@ -0,0 +1,58 @@
+import os
+import time
+import requests
+import aiohttp
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from rate_limit import limiter
+import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+
+# API Configuration
+API_KEY = os.getenv("API_KEY")
+API_BASE = os.getenv("API_BASE", "https://api.balldontlie.io/v1")
+
+# Connection pool and timeout configuration
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 32))
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 30))
+
+# Advertise every encoding urllib3 can decode (brotli when the package is installed)
+headers = {
+    'Authorization': API_KEY,
+    'Accept-Encoding': make_headers(accept_encoding=True)['accept-encoding'],
+}
+
+# One keep-alive session shared by every fetcher; retries are handled by the callers
+session = requests.Session()
+session.headers.update(headers)
+adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+
+def url(endpoint):
+    return f"{API_BASE}/{endpoint}"
+
+def get(endpoint, params=None):
+    metrics.limiter_wait_seconds.observe(limiter.acquire())
+    started = time.monotonic()
+    try:
+        response = session.get(url(endpoint), params=params, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    except requests.exceptions.RequestException:
+        metrics.responses.inc(endpoint=endpoint, status='error')
+        raise
+    finally:
+        metrics.request_seconds.observe(time.monotonic() - started, endpoint=endpoint)
+    metrics.responses.inc(endpoint=endpoint, status=response.status_code)
+    metrics.downloaded_bytes.inc(len(response.content), endpoint=endpoint)
+    limiter.observe(response.status_code, response.headers)
+    return response
+
+def async_session(concurrency):
+    # aiohttp counterpart for the async engine, with the same headers and timeouts
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    return aiohttp.ClientSession(headers=headers, connector=connector, timeout=timeout)
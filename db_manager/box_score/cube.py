@@ -0,0 +1,147 @@
+import argparse
+import pandas as pd
+import database
+
+# Cube cells are keyed by these dimensions and hold additive sums of these player_game columns
+DIMENSIONS = ['season', 'team_id', 'position', 'postseason']
+MEASURES = ['min', 'fgm', 'fga', 'fg3m', 'fg3a', 'ftm', 'fta', 'oreb', 'dreb', 'reb', 'ast', 'stl', 'blk', 'turnover', 'pf', 'pts']
+
+cell_columns = DIMENSIONS + ['player_games'] + MEASURES
+cell_list = ', '.join(cell_columns)
+key_list = ', '.join(DIMENSIONS)
+
+# Rows loaded before player_game carried a team land in team 0, games without a postseason flag in the regular season
+game_cells_select = f"""
+SELECT player_game.game_id, game.season, COALESCE(player_game.team_id, 0), COALESCE(player.position, ''),
+    COALESCE(game.postseason, false), COUNT(*), {', '.join(f'SUM(player_game.{measure})' for measure in MEASURES)}
+FROM player_game
+INNER JOIN game ON game.game_id = player_game.game_id
+INNER JOIN player ON player.player_id = player_game.player_id
+WHERE player_game.game_id = ANY(%s)
+GROUP BY 1, 2, 3, 4, 5
+"""
+
+def merge_into_cube(source, sign):
+    # Add (or subtract) a set of game contributions to their cells; ordered so concurrent writers lock cells alike
+    totals = ', '.join(f"{sign}SUM({column})" for column in ['player_games'] + MEASURES)
+    return f"""
+INSERT INTO rollup_cube ({cell_list})
+SELECT {key_list}, {totals}
+FROM {source}
+GROUP BY {key_list}
+ORDER BY {key_list}
+ON CONFLICT ({key_list}) DO UPDATE SET
+    ({', '.join(['player_games'] + MEASURES)}) = ({', '.join(f'rollup_cube.{column} + EXCLUDED.{column}' for column in ['player_games'] + MEASURES)});
+"""
+
+retract_query = f"""
+WITH retracted AS (
+    DELETE FROM rollup_cube_game WHERE game_id = ANY(%s) RETURNING *
+)
+{merge_into_cube('retracted', '-')}
+"""
+
+apply_query = f"""
+WITH applied AS (
+    INSERT INTO rollup_cube_game (game_id, {cell_list})
+    {game_cells_select}
+    RETURNING *
+)
+{merge_into_cube('applied', '')}
+"""
+
+# Writers reloading games of the same season take turns on its cells, always locking seasons in the same
+# order; a game's old contribution is locked by its season too, so retract and apply cannot interleave
+lock_seasons_query = """
+SELECT season, pg_advisory_xact_lock(hashtext('rollup_cube'), season)
+FROM (
+    SELECT season FROM game WHERE game_id = ANY(%s)
+    UNION
+    SELECT season FROM rollup_cube_game WHERE game_id = ANY(%s)
+) AS seasons
+ORDER BY season;
+"""
+
+def available(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('rollup_cube') IS NOT NULL AND to_regclass('rollup_cube_game') IS NOT NULL;")
+        return cur.fetchone()[0]
+
+def refresh(cursor, game_ids):
+    # Swap the touched games' old contributions for their current ones
+    game_ids = sorted(set(game_ids))
+    if not game_ids:
+        return
+    cursor.execute(lock_seasons_query, [game_ids, game_ids])
+    seasons = [season for season, _ in cursor.fetchall()]
+    cursor.execute(retract_query, [game_ids])
+    if cursor.rowcount:
+        # Only cells of the locked seasons, as another writer may hold cells of other seasons
+        cursor.execute("DELETE FROM rollup_cube WHERE player_games = 0 AND season = ANY(%s);", [seasons])
+    cursor.execute(apply_query, [game_ids])
+
+def rebuild(conn):
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE rollup_cube_game, rollup_cube;")
+        cur.execute(apply_query.replace("WHERE player_game.game_id = ANY(%s)", ""))
+        cur.execute("SELECT COUNT(*) FROM rollup_cube;")
+        cells = cur.fetchone()[0]
+    conn.commit()
+    return cells
+
+class Cube:
+    # In-memory copy of rollup_cube; group-bys re-aggregate its cells instead of player_game rows
+    def __init__(self, cells):
+        self.cells = cells
+
+    @classmethod
+    def load(cls, conn):
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT {cell_list} FROM rollup_cube;")
+            cells = pd.DataFrame(cur.fetchall(), columns=cell_columns)
+        return cls(cells.astype({column: 'float64' if column == 'min' else 'int64' for column in ['player_games'] + MEASURES}))
+
+    def rollup(self, by=(), where=None, measures=MEASURES, averages=True):
+        # where maps a dimension to one value or a collection of values to keep
+        cells = self.cells
+        for dimension, value in (where or {}).items():
+            values = value if isinstance(value, (list, tuple, set, range)) else [value]
+            cells = cells[cells[dimension].isin(values)]
+
+        columns = ['player_games'] + list(measures)
+        if by:
+            result = cells.groupby(list(by), sort=True)[columns].sum().reset_index()
+        else:
+            result = cells[columns].sum().to_frame().T
+
+        # Per player-game averages
+        if averages:
+            for measure in measures:
+                result[f"avg_{measure}"] = result[measure] / result['player_games']
+        return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain and query the rollup cube")
+    parser.add_argument('command', choices=['rebuild', 'show'], help='Rebuild the cube from player_game, or print a rollup')
+    parser.add_argument('--by', nargs='*', choices=DIMENSIONS, default=['season'], help='Dimensions to group by')
+    parser.add_argument('--season', type=int, nargs='*', help='Only these seasons')
+    parser.add_argument('--team_id', type=int, nargs='*', help='Only these teams')
+    parser.add_argument('--position', nargs='*', help='Only these positions')
+    parser.add_argument('--postseason', choices=['true', 'false'], help='Only postseason or regular season games')
+    args = parser.parse_args()
+
+    conn = database.connect()
+    try:
+        if args.command == 'rebuild':
+            print(f"Rebuilt rollup cube with {rebuild(conn)} cells")
+        else:
+            where = {dimension: getattr(args, dimension) for dimension in ['season', 'team_id', 'position'] if getattr(args, dimension)}
+            if args.postseason:
+                where['postseason'] = args.postseason == 'true'
+            with pd.option_context('display.max_rows', None, 'display.width', None):
+                print(Cube.load(conn).rollup(args.by, where))
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,76 +1,174 @@
 import os
-import psycopg2
+from threading import Lock
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from records import SCHEMA, RecordBatch, hashed_tables
+import aggregates
+import metrics
+import cube
+import storage
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Database connection details
-conn_str = (f"dbname=box_scores user={os.getenv('DB_USER')} " +
-            f"password={os.getenv('DB_PASS')} host={os.getenv('DB_HOST')} " +
-            f"port={os.getenv('DB_PORT')}")
-
-# Connect to PostgreSQL server
-conn = psycopg2.connect(conn_str)
-cursor = conn.cursor()
-
-# Create an engine instance
-engine = create_engine(f'postgresql+psycopg2://{os.getenv("DB_USER")}:{os.getenv("DB_PASS")}@{os.getenv("DB_HOST")}:{os.getenv("DB_PORT")}/nba_stats')
-
-# Insert queries
-player_insert_query = """
-INSERT INTO player (
-    player_id, first_name, last_name, position, height, weight, jersey_number, college, country, draft_year, draft_round, draft_number
-) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-ON CONFLICT (player_id) DO NOTHING;
-"""
-
-game_insert_query = """
-INSERT INTO game (
-    game_id, date, season, home_team_score, visitor_team_score, home_team_id, visitor_team_id
-) VALUES (%s, %s, %s, %s, %s, %s, %s)
-ON CONFLICT (game_id) DO NOTHING;
-"""
-
-player_game_insert_query = """
-INSERT INTO player_game (
-    player_id, game_id, min, fgm, fga, fg_pct, fg3m, fg3a, fg3_pct, ftm, fta, ft_pct, oreb, dreb, reb, ast, stl, blk, turnover, pf, pts
-) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-ON CONFLICT (player_id, game_id) DO NOTHING;
-"""
-
-player_team_insert_query = """
-INSERT INTO player_team (
-    player_id, team_id
-) VALUES (%s, %s)
-ON CONFLICT (player_id, team_id) DO NOTHING;
-"""
-
-team_game_insert_query = """
-INSERT INTO team_game (
-    team_id, game_id
-) VALUES (%s, %s)
-ON CONFLICT (team_id, game_id) DO NOTHING;
-"""
+# Storage backend the pipeline writes to: 'postgres' or the embedded 'duckdb'
+backend_name = os.getenv("DB_BACKEND", "postgres")
+backend = None
+
+def get_backend():
+    global backend
+    if backend is None:
+        backend = storage.backends[backend_name]()
+    return backend
+
+def use(name):
+    global backend_name, backend
+    backend_name, backend = name, None
+
+def get_conn():
+    # The shared connection opens on first use rather than at import time
+    global conn
+    if 'conn' not in globals():
+        conn = connect()
+    return conn
+
+def __getattr__(name):
+    if name == 'conn':
+        return get_conn()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Columns and conflict keys of each table, in load order
+conflict_keys = {
+    'player': ['player_id'],
+    'game': ['game_id'],
+    'player_game': ['player_id', 'game_id'],
+    'player_team': ['player_id', 'team_id'],
+    'team_game': ['team_id', 'game_id'],
+}
+tables = {table: ([name for name, _ in SCHEMA[table]], conflict_keys[table]) for table in SCHEMA}
+
+# Season-partitioned tables include the partition key in their primary key
+partitioned_conflict_keys = {
+    'game': ['game_id', 'season'],
+    'player_game': ['player_id', 'game_id', 'season'],
+}
+
+def set_layout(partitioned):
+    # Match the conflict keys to the layout create_db.py built
+    for table in partitioned_conflict_keys:
+        key = partitioned_conflict_keys[table] if partitioned else conflict_keys[table]
+        tables[table] = (tables[table][0], key)
+
+def configure(connection):
+    # Lets the backend match the schema it finds and decide which derived tables it can maintain
+    return get_backend().configure(connection)
+
+# Tables whose changed rows are updated in place instead of skipped; merge mode adds the fact tables
+update_on_conflict = {'player'}
+
+def merge(enabled=True):
+    # Stat corrections and final scores replace the stored rows, and only rows whose row_hash changed are written
+    if enabled:
+        update_on_conflict.update(hashed_tables)
+    else:
+        update_on_conflict.difference_update(hashed_tables)
+
+def merging(table):
+    return table in update_on_conflict and table in hashed_tables
+
+def merge_enabled():
+    return bool(update_on_conflict & hashed_tables)
+
+def conflict_action(table):
+    columns, key = tables[table]
+    if table not in update_on_conflict:
+        return "DO NOTHING"
+    values = [column for column in columns if column not in key]
+    excluded = ', '.join(f"EXCLUDED.{column}" for column in values)
+    if table in hashed_tables:
+        changed = f"{table}.row_hash IS DISTINCT FROM EXCLUDED.row_hash"
+    else:
+        changed = f"({', '.join(f'{table}.{column}' for column in values)}) IS DISTINCT FROM ({excluded})"
+    return f"DO UPDATE SET ({', '.join(values)}) = ({excluded}) WHERE {changed}"
+
+# Postgres loader used by batch_insert: 'copy' streams through staging tables, 'insert' uses executemany
+loader = 'copy'
+
+# Keep game_aggregate and season_aggregate current in the same transaction as every write
+maintain_aggregates = True
+
+# Likewise for rollup_cube
+maintain_cube = True
+
+# Running totals of (inserted, skipped) rows per table
+load_stats = {table: [0, 0] for table in tables}
+stats_lock = Lock()
+
+def connect():
+    return get_backend().connect()
+
+def execute_values(cur, query, rows, template=None):
+    return get_backend().execute_values(cur, query, rows, template)
+
+def record_stats(stats):
+    with stats_lock:
+        for table, (inserted, skipped) in stats.items():
+            load_stats[table][0] += inserted
+            load_stats[table][1] += skipped
+            metrics.rows.inc(inserted, table=table, result='inserted')
+            metrics.rows.inc(skipped, table=table, result='skipped')
+
+def write_batches(connection, batches, dimensions=None):
+    # Write several record batches in the caller's transaction, one load per table.
+    # Returns the per-table stats and the dimension keys to remember once the transaction commits.
+    load = get_backend().load
+    stats = {}
+    staged = {}
+    game_ids = set()
+    # When merging, only the games whose rows were actually written need their derived rows refreshed
+    changed = set() if any(merging(table) for table in hashed_tables) else None
+    with connection.cursor() as cur:
+        for i, table in enumerate(tables):
+            records = RecordBatch.concat(table, [batch[i] for batch in batches])
+            total = len(records)
+            if table in ('game', 'player_game'):
+                game_ids.update(records.columns['game_id'].tolist())
+            if dimensions is not None:
+                records, staged[table] = dimensions.filter(table, records)
+            if total:
+                with metrics.load_seconds.time(table=table):
+                    written = changed if changed is not None and table in hashed_tables else None
+                    inserted = load(cur, table, records, written) if len(records) else 0
+                stats[table] = (inserted, total - inserted)
+        if changed is not None:
+            game_ids = changed
+        if get_backend().derived_tables:
+            if maintain_aggregates:
+                with metrics.load_seconds.time(table='game_aggregate'):
+                    aggregates.refresh(cur, game_ids)
+            if maintain_cube:
+                with metrics.load_seconds.time(table='rollup_cube'):
+                    cube.refresh(cur, game_ids)
+    return stats, staged
 
 def batch_insert(player_records, game_records, player_game_records, player_team_records, team_game_records):
+    batch = (player_records, game_records, player_game_records, player_team_records, team_game_records)
+    conn = get_conn()
     try:
-        if player_records:
-            cursor.executemany(player_insert_query, player_records)
-        if game_records:
-            cursor.executemany(game_insert_query, game_records)
-        if player_game_records:
-            cursor.executemany(player_game_insert_query, player_game_records)
-        if player_team_records:
-            cursor.executemany(player_team_insert_query, player_team_records)
-        if team_game_records:
-            cursor.executemany(team_game_insert_query, team_game_records)
+        stats, _ = write_batches(conn, [batch])
         conn.commit()
     except Exception as e:
         print(f"Error during batch insert: {e}")
         conn.rollback()
+        return {}
+
+    record_stats(stats)
+    return stats
+
+def format_stats(stats):
+    return ', '.join(f"{table}: +{inserted}/{skipped} skipped" for table, (inserted, skipped) in stats.items())
 
 def close_connection():
-    cursor.close()
-    conn.close()
+    if 'conn' in globals():
+        globals().pop('conn').close()
+    if backend is not None:
+        backend.close()
@@ -0,0 +1,251 @@
+import argparse
+import datetime
+import os
+import random
+import time
+from threading import Condition, Event, Lock
+from dotenv import load_dotenv
+from tenacity import RetryError
+from tqdm import tqdm
+import database
+import checkpoint
+import metrics
+from cache import season_bounds
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Seconds before the first retry of a failed date, doubling with every further attempt up to the cap
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 30))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 60 * 60))
+
+# Delays are bound as intervals, which Postgres and DuckDB both add to now()
+def seconds(value):
+    return datetime.timedelta(seconds=value)
+
+# Attempts are counted before the upsert, so the backoff is set in the same statement: DuckDB cannot
+# update a row its transaction has just upserted, nor run UPDATE ... RETURNING on a keyed table
+attempts_query = """
+SELECT attempts
+FROM dead_letter
+WHERE date = %s;
+"""
+
+record_query = """
+INSERT INTO dead_letter (date, stage, error_class, error, attempts, first_failed_at, last_failed_at, next_attempt_at)
+VALUES (%s, %s, %s, %s, %s, now(), now(), now() + %s)
+ON CONFLICT (date) DO UPDATE SET
+    stage = EXCLUDED.stage,
+    error_class = EXCLUDED.error_class,
+    error = EXCLUDED.error,
+    attempts = EXCLUDED.attempts,
+    last_failed_at = now(),
+    next_attempt_at = EXCLUDED.next_attempt_at;
+"""
+
+due_query = """
+SELECT date
+FROM dead_letter
+WHERE date BETWEEN %s AND %s AND attempts < %s AND next_attempt_at <= now()
+ORDER BY next_attempt_at
+LIMIT %s;
+"""
+
+# Due retries are pushed back by hold_seconds as they are handed out, so the next poll does not hand them out again
+hold_query = """
+UPDATE dead_letter
+SET next_attempt_at = now() + %s
+WHERE date = ANY(%s::date[]);
+"""
+
+upcoming_query = """
+SELECT EXISTS (
+    SELECT 1
+    FROM dead_letter
+    WHERE date BETWEEN %s AND %s AND attempts < %s
+      AND next_attempt_at <= now() + %s
+);
+"""
+
+resolve_query = """
+DELETE FROM dead_letter
+WHERE date = ANY(%s::date[]);
+"""
+
+report_query = """
+SELECT COUNT(*) FILTER (WHERE attempts < %s), COUNT(*) FILTER (WHERE attempts >= %s)
+FROM dead_letter
+WHERE date BETWEEN %s AND %s;
+"""
+
+list_query = """
+SELECT date, stage, error_class, attempts, last_failed_at, next_attempt_at, error
+FROM dead_letter
+ORDER BY date;
+"""
+
+requeue_query = """
+UPDATE dead_letter
+SET attempts = 0, next_attempt_at = now()
+RETURNING date;
+"""
+
+def backoff(attempts, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    # Half the exponential delay is fixed and half random, so a burst of failures does not retry in lockstep
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def resolve(conn, dates):
+    # Runs inside the writer's transaction, next to the checkpoint update
+    with conn.cursor() as cur:
+        cur.execute(resolve_query, [[str(date) for date in dates]])
+    dead_letters.settle(dates)
+
+def claim_due(conn, first, last, max_attempts, hold_seconds, limit=100):
+    with conn.cursor() as cur:
+        cur.execute(due_query, [first, last, max_attempts, limit])
+        dates = sorted(date.isoformat() for (date,) in cur.fetchall())
+        if dates:
+            cur.execute(hold_query, [seconds(hold_seconds), dates])
+    conn.commit()
+    return dates
+
+def upcoming(conn, first, last, max_attempts, within):
+    with conn.cursor() as cur:
+        cur.execute(upcoming_query, [first, last, max_attempts, seconds(within)])
+        result = cur.fetchone()[0]
+    conn.commit()
+    return result
+
+def report(conn, seasons, max_attempts):
+    first, last = season_bounds(seasons)
+    with conn.cursor() as cur:
+        cur.execute(report_query, [max_attempts, max_attempts, first, last])
+        waiting, exhausted = cur.fetchone()
+    conn.commit()
+    return f"{waiting} dates awaiting retry, {exhausted} out of attempts"
+
+class DeadLetters:
+    # Records failed dates as they fail, from any fetch, parse or writer thread, on one shared connection.
+    # Each failure bumps the date's attempts, schedules its next attempt and marks its checkpoint failed,
+    # which also releases a distributed lease. Also tracks the dates handed to the pipeline that have not
+    # yet been written, skipped as unchanged or recorded as failed, since any of them may still fail.
+    def __init__(self):
+        self.lock = Lock()
+        self.conn = None
+        self.in_flight = set()
+        # Set once the date stream has run out, so writers commit what they hold instead of waiting
+        # out their flush timer while the retry tail waits on those dates
+        self.draining = Event()
+        # Failed dates that could not be recorded, reported at the end of the run
+        self.unrecorded = []
+        # Notified whenever the last date in flight settles
+        self.in_flight_lock = Condition()
+
+    def track(self, date):
+        with self.in_flight_lock:
+            self.in_flight.add(date)
+
+    def settle(self, dates):
+        with self.in_flight_lock:
+            self.in_flight.difference_update(dates)
+            if not self.in_flight:
+                self.in_flight_lock.notify_all()
+
+    def busy(self):
+        with self.in_flight_lock:
+            return bool(self.in_flight)
+
+    def wait(self, timeout):
+        # Returns once nothing is in flight, or after timeout seconds
+        with self.in_flight_lock:
+            return self.in_flight_lock.wait_for(lambda: not self.in_flight, timeout)
+
+    def add(self, date, stage, error):
+        # Tenacity wraps the last failure of a call it gave up retrying
+        if isinstance(error, RetryError) and error.last_attempt.exception() is not None:
+            error = error.last_attempt.exception()
+        with self.lock:
+            if self.conn is None:
+                self.conn = database.connect()
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute(attempts_query, [str(date)])
+                    row = cur.fetchone()
+                    attempts = (row[0] if row else 0) + 1
+                    cur.execute(record_query, [str(date), stage, type(error).__name__, str(error)[:1000], attempts,
+                                               seconds(backoff(attempts))])
+                checkpoint.mark_failed(self.conn, [date])
+            except Exception as e:
+                # Neither dead-lettered nor marked failed, so the date is left for --resume
+                self.conn.rollback()
+                tqdm.write(f"Error recording failed date {date}: {e}")
+                self.unrecorded.append((date, e))
+        self.settle([date])
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+def with_retries(dates, seasons, max_attempts=5, max_wait=300, hold_seconds=120, poll_interval=5.0):
+    # Yields dates with the due retries of the requested seasons slipped in between, so a failed date
+    # is retried while the backfill goes on. Once dates runs out, keeps yielding retries as they come
+    # due while any date is still in flight or a retry is due within max_wait seconds; later ones wait
+    # in dead_letter for the next run.
+    first, last = season_bounds(seasons)
+    conn = database.connect()
+    try:
+        checked = 0.0
+        for date in dates:
+            if time.monotonic() - checked >= poll_interval:
+                for retry in claim_due(conn, first, last, max_attempts, hold_seconds):
+                    metrics.dates.inc(outcome='retried')
+                    dead_letters.track(retry)
+                    yield retry
+                checked = time.monotonic()
+            dead_letters.track(date)
+            yield date
+        dead_letters.draining.set()
+        while True:
+            due = claim_due(conn, first, last, max_attempts, hold_seconds)
+            if due:
+                metrics.dates.inc(len(due), outcome='retried')
+                for retry in due:
+                    dead_letters.track(retry)
+                    yield retry
+            elif dead_letters.busy():
+                # Checks again as soon as the last date settles, rather than a whole poll_interval later
+                dead_letters.wait(poll_interval)
+            elif upcoming(conn, first, last, max_attempts, max_wait):
+                time.sleep(poll_interval)
+            else:
+                return
+    finally:
+        conn.close()
+
+# Process-wide recorder shared by every stage
+dead_letters = DeadLetters()
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or requeue dates that failed to load")
+    parser.add_argument('command', choices=['list', 'requeue'], help='list the dead letters, or make every one due again with fresh attempts')
+    args = parser.parse_args()
+
+    conn = database.connect()
+    try:
+        with conn.cursor() as cur:
+            if args.command == 'list':
+                cur.execute(list_query)
+                for date, stage, error_class, attempts, last_failed_at, next_attempt_at, error in cur.fetchall():
+                    print(f"{date} {stage:<6} {error_class:<24} attempts={attempts} last={last_failed_at:%Y-%m-%d %H:%M} next={next_attempt_at:%Y-%m-%d %H:%M} {error}")
+            else:
+                cur.execute(requeue_query)
+                print(f"Requeued {len(cur.fetchall())} dates")
+        conn.commit()
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+from threading import Lock
+import numpy as np
+from records import SCHEMA, RecordBatch
+
+player_columns = [name for name, _ in SCHEMA['player']]
+
+class DimensionCache:
+    # Remembers which player rows and (player_id, team_id) pairs are already in the database,
+    # so writers only send new or changed dimension rows.
+    def __init__(self):
+        self.lock = Lock()
+        self.players = {}  # player_id -> hash of the stored row
+        self.player_teams = set()
+        self.hits = {'player': 0, 'player_team': 0}
+        self.misses = {'player': 0, 'player_team': 0}
+
+    def warm(self, conn):
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT {', '.join(player_columns)} FROM player;")
+            players = {row[0]: hash(row) for row in cur.fetchall()}
+            cur.execute("SELECT player_id, team_id FROM player_team;")
+            player_teams = set(cur.fetchall())
+        with self.lock:
+            self.players.update(players)
+            self.player_teams.update(player_teams)
+        return len(players), len(player_teams)
+
+    def filter(self, table, batch):
+        # Returns the rows of batch that still need writing and the keys to remember once they commit
+        if table == 'player':
+            keys = [(row[0], hash(row)) for row in batch.rows()]
+            with self.lock:
+                known = self.players
+                seen = {}
+                mask = np.zeros(len(keys), dtype=bool)
+                for i, (player_id, row_hash) in enumerate(keys):
+                    if known.get(player_id) != row_hash and seen.get(player_id) != row_hash:
+                        mask[i] = True
+                        seen[player_id] = row_hash
+            staged = list(seen.items())
+        elif table == 'player_team':
+            keys = list(zip(batch.columns['player_id'].tolist(), batch.columns['team_id'].tolist()))
+            with self.lock:
+                known = self.player_teams
+                seen = set()
+                mask = np.zeros(len(keys), dtype=bool)
+                for i, key in enumerate(keys):
+                    if key not in known and key not in seen:
+                        mask[i] = True
+                        seen.add(key)
+            staged = list(seen)
+        else:
+            return batch, []
+
+        with self.lock:
+            self.misses[table] += int(mask.sum())
+            self.hits[table] += len(mask) - int(mask.sum())
+        return RecordBatch(table, {name: column[mask] for name, column in batch.columns.items()}), staged
+
+    def remember(self, staged):
+        with self.lock:
+            for table, keys in staged.items():
+                if table == 'player':
+                    self.players.update(keys)
+                elif table == 'player_team':
+                    self.player_teams.update(keys)
+
+    def hit_rate(self):
+        with self.lock:
+            hits = sum(self.hits.values())
+            total = hits + sum(self.misses.values())
+        return hits / total if total else 0.0
+
+    def report(self):
+        with self.lock:
+            parts = [f"{table}: {self.hits[table]} cached/{self.misses[table]} written" for table in self.hits]
+        return f"{', '.join(parts)} ({self.hit_rate():.1%} hit rate)"
+
+# Run-scoped cache shared by every writer
+dimensions = DimensionCache()
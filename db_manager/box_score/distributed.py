@@ -0,0 +1,202 @@
+import hashlib
+import os
+import socket
+import time
+from threading import Thread, Event
+from tqdm import tqdm
+import database
+import checkpoint
+from cache import season_bounds
+
+# Any number of workers on any number of hosts share one ingest_checkpoint table: each claims a few
+# dates at a time under a lease it keeps renewing, and dates whose worker died are claimed again once
+# the lease runs out. Postgres only, since claiming relies on FOR UPDATE SKIP LOCKED.
+
+# Identifies this worker's leases
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Failed dates come back once their dead letter is due, until they run out of attempts
+claim_query = """
+WITH claimable AS (
+    SELECT date
+    FROM ingest_checkpoint
+    WHERE date BETWEEN %(first)s AND %(last)s
+      AND (status = 'pending'
+           OR (status = 'failed' AND NOT EXISTS (
+                   SELECT FROM dead_letter
+                   WHERE dead_letter.date = ingest_checkpoint.date
+                     AND (dead_letter.attempts >= %(max_attempts)s OR dead_letter.next_attempt_at > now())))
+           OR (status = 'leased' AND lease_until < now()))
+    ORDER BY date
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE ingest_checkpoint
+SET status = 'leased', leased_by = %(worker)s, lease_until = now() + %(lease)s * interval '1 second', updated_at = now()
+FROM claimable
+WHERE ingest_checkpoint.date = claimable.date
+RETURNING ingest_checkpoint.date;
+"""
+
+# Work other workers still hold or have yet to claim, including retries due within max_wait seconds;
+# this worker's own leases are already queued locally
+outstanding_query = """
+SELECT EXISTS (
+    SELECT FROM ingest_checkpoint
+    WHERE date BETWEEN %(first)s AND %(last)s
+      AND (status = 'pending'
+           OR (status = 'failed' AND NOT EXISTS (
+                   SELECT FROM dead_letter
+                   WHERE dead_letter.date = ingest_checkpoint.date
+                     AND (dead_letter.attempts >= %(max_attempts)s
+                          OR dead_letter.next_attempt_at > now() + %(max_wait)s * interval '1 second')))
+           OR (status = 'leased' AND leased_by <> %(worker)s))
+);
+"""
+
+renew_query = """
+UPDATE ingest_checkpoint
+SET lease_until = now() + %s * interval '1 second'
+WHERE status = 'leased' AND leased_by = %s;
+"""
+
+# Dates around today can still change, so discovering them again puts them back in the queue
+reopen_query = """
+UPDATE ingest_checkpoint
+SET status = 'pending', updated_at = now()
+WHERE status = 'done' AND date >= current_date - 1 AND date = ANY(%s::date[]);
+"""
+
+quota_select = """
+SELECT tokens, updated, paused_until, rate
+FROM api_quota
+WHERE api_key_hash = %s
+FOR UPDATE;
+"""
+
+quota_upsert = """
+INSERT INTO api_quota (api_key_hash, tokens, updated, paused_until, rate)
+VALUES (%s, %s, %s, %s, %s)
+ON CONFLICT (api_key_hash) DO UPDATE SET
+    tokens = EXCLUDED.tokens,
+    updated = EXCLUDED.updated,
+    paused_until = EXCLUDED.paused_until,
+    rate = EXCLUDED.rate;
+"""
+
+def register(conn, dates):
+    checkpoint.register(conn, dates)
+    with conn.cursor() as cur:
+        cur.execute(reopen_query, [[str(date) for date in dates]])
+    conn.commit()
+
+def claim(conn, first, last, limit, lease_seconds, max_attempts):
+    with conn.cursor() as cur:
+        cur.execute(claim_query, {'first': first, 'last': last, 'limit': limit, 'lease': lease_seconds,
+                                  'max_attempts': max_attempts, 'worker': WORKER_ID})
+        dates = sorted(date.isoformat() for (date,) in cur.fetchall())
+    conn.commit()
+    return dates
+
+def outstanding(conn, first, last, max_attempts, max_wait):
+    with conn.cursor() as cur:
+        cur.execute(outstanding_query, {'first': first, 'last': last, 'max_attempts': max_attempts, 'max_wait': max_wait, 'worker': WORKER_ID})
+        result = cur.fetchone()[0]
+    conn.commit()
+    return result
+
+class Heartbeat(Thread):
+    # Renews every lease this worker holds, including dates still waiting in its local queues
+    def __init__(self, lease_seconds):
+        super().__init__(daemon=True)
+        self.lease_seconds = lease_seconds
+        self.stopped = Event()
+
+    def run(self):
+        conn = database.connect()
+        try:
+            while not self.stopped.wait(self.lease_seconds / 3):
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(renew_query, [self.lease_seconds, WORKER_ID])
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    tqdm.write(f"Error renewing leases: {e}")
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class Discovery(Thread):
+    # Registers the dates of the requested seasons in the work table while workers claim them
+    def __init__(self, dates):
+        super().__init__(daemon=True)
+        self.dates = dates
+        self.error = None
+
+    def run(self):
+        conn = database.connect()
+        try:
+            for new_dates, ack in self.dates:
+                if new_dates:
+                    register(conn, new_dates)
+                ack()
+        except Exception as e:
+            tqdm.write(f"Discovery stopped: {e}")
+            self.error = e
+        finally:
+            conn.close()
+
+def claimed_dates(seasons, discovery=None, batch=16, lease_seconds=300, max_attempts=5, max_wait=300, poll_interval=1.0):
+    # Dates this worker has leased, claimed a batch at a time. Ends once discovery is over and no other
+    # worker holds or has yet to claim a date, so a lease that expires is picked up by whoever is left;
+    # failed dates whose next attempt is further than max_wait seconds away are left for a later run.
+    first, last = season_bounds(seasons)
+    conn = database.connect()
+    try:
+        while True:
+            dates = claim(conn, first, last, batch, lease_seconds, max_attempts)
+            if dates:
+                yield from dates
+                continue
+            discovering = discovery is not None and discovery.is_alive()
+            if not discovering and not outstanding(conn, first, last, max_attempts, max_wait):
+                return
+            time.sleep(poll_interval)
+    finally:
+        conn.close()
+
+class SharedQuota:
+    # Token bucket state of one API key in the api_quota table, for TokenBucket.share. The row lock
+    # serializes every worker using the key, and times are kept on the database clock so clock skew
+    # between hosts does not hand out extra tokens.
+    def __init__(self, conn, api_key):
+        self.conn = conn
+        self.key = hashlib.sha256((api_key or '').encode()).hexdigest()
+        with conn.cursor() as cur:
+            cur.execute("SELECT EXTRACT(EPOCH FROM clock_timestamp())::float8;")
+            self.offset = cur.fetchone()[0] - time.time()
+        conn.commit()
+
+    def update(self, fn, default):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(quota_select, [self.key])
+                row = cur.fetchone()
+                if row is None:
+                    state = dict(default)
+                else:
+                    tokens, updated, paused_until, rate = row
+                    state = {'tokens': tokens, 'updated': updated - self.offset,
+                             'paused_until': paused_until - self.offset, 'rate': rate}
+                result = fn(state)
+                cur.execute(quota_upsert, [self.key, state['tokens'], state['updated'] + self.offset,
+                                           state['paused_until'] + self.offset, state['rate']])
+            self.conn.commit()
+            return result
+        except Exception:
+            self.conn.rollback()
+            raise
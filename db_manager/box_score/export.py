@@ -0,0 +1,182 @@
+import argparse
+import datetime
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'export')
+MANIFEST = 'manifest.json'
+
+# Columns, source and season expression of each exported table; tables without a season are exported whole
+sources = {
+    'game': ("game.*", "game", "game.season"),
+    'player_game': ("player_game.*", "player_game", "player_game.season"),
+    'team_game': ("team_game.*", "team_game INNER JOIN game ON game.game_id = team_game.game_id", "game.season"),
+    'player': ("player.*", "player", None),
+    'team': ("team.*", "team", None),
+    'player_team': ("player_team.*", "player_team", None),
+}
+
+# Arrow types of the Postgres column types in these tables, keyed by type OID, so every season
+# gets the same schema even when a column is entirely null in one of them
+arrow_types = {16: pa.bool_(), 20: pa.int64(), 23: pa.int32(), 25: pa.string(), 701: pa.float64(),
+               1043: pa.string(), 1082: pa.date32(), 1184: pa.timestamp('us', tz='UTC')}
+
+def signature_query(table):
+    # Order-independent fingerprint of each season's rows, so unchanged seasons are not rewritten
+    _, source, season = sources[table]
+    fingerprint = f"COUNT(*) || ':' || COALESCE(SUM(hashtext({table}::text)::bigint), 0)"
+    if season is None:
+        return f"SELECT 'all', {fingerprint} FROM {source};"
+    return f"SELECT {season}::text, {fingerprint} FROM {source} GROUP BY {season};"
+
+def connect():
+    # Imported here so reading an export back never needs a database server
+    import database
+    return database.connect()
+
+def signatures(conn, table):
+    with conn.cursor() as cur:
+        cur.execute(signature_query(table))
+        return dict(cur.fetchall())
+
+def fetch_table(conn, table, season):
+    columns, source, season_column = sources[table]
+    with conn.cursor() as cur:
+        if season == 'all':
+            cur.execute(f"SELECT {columns} FROM {source};")
+        else:
+            cur.execute(f"SELECT {columns} FROM {source} WHERE {season_column} = %s;", [int(season)])
+        description = cur.description
+        rows = cur.fetchall()
+    values = list(zip(*rows)) if rows else [[] for _ in description]
+    return pa.table({column.name: pa.array(value, type=arrow_types.get(column.type_code))
+                     for column, value in zip(description, values)})
+
+def file_path(table, season, fmt):
+    extension = 'parquet' if fmt == 'parquet' else 'arrow'
+    if season == 'all':
+        return os.path.join(table, f"{table}.{extension}")
+    return os.path.join(table, f"season={season}", f"part.{extension}")
+
+def write_table(data, path, fmt, compression):
+    tmp_path = f"{path}.tmp"
+    if fmt == 'parquet':
+        pq.write_table(data, tmp_path, compression=compression)
+    else:
+        # Arrow IPC is left uncompressed so readers can memory-map it without copying
+        with pa.OSFile(tmp_path, 'wb') as sink, ipc.new_file(sink, data.schema) as writer:
+            writer.write_table(data)
+    os.replace(tmp_path, path)
+
+def export_partition(table, season, signature, root, fmt, compression):
+    # Each job reads on its own connection so tables and seasons export in parallel
+    conn = connect()
+    try:
+        data = fetch_table(conn, table, season)
+    finally:
+        conn.close()
+    path = file_path(table, season, fmt)
+    os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+    write_table(data, os.path.join(root, path), fmt, compression)
+    return table, season, {'path': path, 'rows': data.num_rows, 'bytes': os.path.getsize(os.path.join(root, path)), 'signature': signature}
+
+def load_manifest(root):
+    try:
+        with open(os.path.join(root, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def clear(root, manifest):
+    # Removes every file of an earlier export, along with the season directories it leaves empty
+    for table in manifest.get('tables', {}).values():
+        for entry in table['files'].values():
+            path = os.path.join(root, entry['path'])
+            if os.path.exists(path):
+                os.remove(path)
+            directory = os.path.dirname(path)
+            while os.path.abspath(directory) != os.path.abspath(root) and os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+
+def export(root=EXPORT_DIR, tables=tuple(sources), fmt='parquet', compression='zstd', max_workers=8, full=False):
+    manifest = load_manifest(root)
+    if manifest and manifest.get('format') != fmt:
+        # Files of another format would sit next to the new ones, so the old export goes as a whole
+        clear(root, manifest)
+        manifest = {}
+    elif manifest and fmt == 'parquet' and manifest.get('compression') != compression:
+        full = True
+    files = {table: dict(manifest.get('tables', {}).get(table, {}).get('files', {})) for table in sources}
+
+    conn = connect()
+    try:
+        current = {table: signatures(conn, table) for table in tables}
+    finally:
+        conn.close()
+
+    jobs = []
+    for table in tables:
+        # Seasons that no longer have rows are dropped from the export
+        for season in set(files[table]) - set(current[table]):
+            path = os.path.join(root, files[table].pop(season)['path'])
+            if os.path.exists(path):
+                os.remove(path)
+        for season, signature in current[table].items():
+            if full or files[table].get(season, {}).get('signature') != signature:
+                jobs.append((table, season, signature))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(export_partition, *job, root, fmt, compression) for job in jobs]
+        for future in tqdm(futures, desc="Exporting"):
+            table, season, entry = future.result()
+            files[table][season] = entry
+
+    manifest = {
+        'format': fmt,
+        'compression': compression if fmt == 'parquet' else None,
+        'exported_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'tables': {table: {'partitioned_by': 'season' if sources[table][2] else None,
+                           'files': dict(sorted(files[table].items()))} for table in sources if files[table]},
+    }
+    with open(os.path.join(root, f"{MANIFEST}.tmp"), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(os.path.join(root, f"{MANIFEST}.tmp"), os.path.join(root, MANIFEST))
+    return len(jobs)
+
+def read(table, season=None, root=EXPORT_DIR, columns=None):
+    # Read one season (or a whole table) back; Arrow IPC files are memory-mapped rather than loaded
+    manifest = load_manifest(root)
+    files = manifest['tables'][table]['files']
+    seasons = ['all'] if 'all' in files else [str(season)] if season is not None else list(files)
+    parts = []
+    for key in seasons:
+        path = os.path.join(root, files[key]['path'])
+        if manifest['format'] == 'parquet':
+            parts.append(pq.read_table(path, columns=columns, memory_map=True))
+        else:
+            data = ipc.open_file(pa.memory_map(path, 'r')).read_all()
+            parts.append(data.select(columns) if columns else data)
+    return pa.concat_tables(parts)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the box_scores tables to columnar files partitioned by season")
+    parser.add_argument('--output', default=EXPORT_DIR, help='Directory the files and manifest are written to')
+    parser.add_argument('--tables', nargs='*', choices=list(sources), default=list(sources), help='Tables to export')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet', help='Compressed Parquet or memory-mappable Arrow IPC')
+    parser.add_argument('--compression', default='zstd', help='Parquet compression codec')
+    parser.add_argument('--max_workers', type=int, default=8, help='Partitions exported concurrently')
+    parser.add_argument('--full', action='store_true', help='Rewrite every partition, even unchanged ones')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    written = export(args.output, args.tables, args.format, args.compression, args.max_workers, args.full)
+    print(f"Wrote {written} partitions to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,25 @@
-import os
-from dotenv import load_dotenv
+import json
 import requests
-from tqdm import tqdm
 from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_exception_type
-import numpy as np
-
-# Take environment variables from .env.
-load_dotenv()
+from rate_limit import wait_for_limiter
+import client
+import cache
+import metrics
+from paginate import paginate_seasons
 
 # API Configuration
-API_KEY = os.getenv("API_KEY")
-API_ENDPOINT = "https://api.balldontlie.io/v1/games"
+API_ENDPOINT = "games"
 
-# Set up the headers with the API key.
-headers = {
-    'Authorization': API_KEY
-}
+@retry(wait=wait_for_limiter(wait_exponential(multiplier=1, min=4, max=10)), stop=stop_after_attempt(5), retry=retry_if_exception_type(requests.exceptions.RequestException), before_sleep=metrics.count_retry(API_ENDPOINT))
+def fetch_page(params):
+    response = client.get(API_ENDPOINT, params)
+    response.raise_for_status()  # Raise an exception for HTTP errors
+    return response.content
 
-@retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(5), retry=retry_if_exception_type(requests.exceptions.RequestException))
 def make_request(params):
-    response = requests.get(API_ENDPOINT, headers=headers, params=params)
-    response.raise_for_status()  # Raise an exception for HTTP errors
-    return response
+    return cache.get_or_fetch(API_ENDPOINT, params, fetch_page)
 
-def fetch_data(season):
-    cur_cursor = None
+def fetch_data(season, cur_cursor=None):
     while True:
         params = {
             "seasons[]": season,
@@ -32,33 +27,37 @@ def fetch_data(season):
         }
         if cur_cursor:
             params["cursor"] = cur_cursor
-        try:
-            response = make_request(params)
-            data = response.json()
-            yield data['data'], len(response.content)
-            cur_cursor = data['meta'].get('next_cursor', None)
-            if not cur_cursor:
-                break
-        except requests.exceptions.HTTPError as e:
-            tqdm.write(f"HTTPError: {e.response.status_code} for URL: {e.response.url}")
-            break
-        except Exception as e:
-            tqdm.write(f"Exception: {str(e)}")
+        # Errors end the chain, which reports them and keeps its cursor for --resume
+        body = make_request(params)
+        data = json.loads(body)
+        cur_cursor = data['meta'].get('next_cursor', None)
+        yield data['data'], len(body), cur_cursor
+        if not cur_cursor:
             break
 
+def iter_date_pages(seasons, max_workers=8, resume=False):
+    # Emit each games page's unseen dates as soon as the page arrives, with the ack to call once they
+    # are registered; pages with no unseen dates are emitted too, so their cursor is still saved
+    seen = set()
+    for data_page, data_size, ack in paginate_seasons(fetch_data, API_ENDPOINT, seasons, max_workers, resume):
+        metrics.payload_bytes.inc(data_size, endpoint=API_ENDPOINT)
+        new_dates = []
+        for record in data_page:
+            date = record['date']
+            if date not in seen:
+                seen.add(date)
+                new_dates.append(date)
+        yield new_dates, ack
+
+def iter_dates(seasons):
+    for new_dates, ack in iter_date_pages(seasons):
+        ack()
+        yield from new_dates
+
 def fetch_and_store_data(seasons):
-    dates = np.array([])
-    total_bytes = 0 
-    for season in tqdm(seasons, desc="Seasons", unit="season"):
-        data_generator = fetch_data(season)
-        for data_page, data_size in tqdm(data_generator, desc=f"Season {season}", unit="page", leave=False):
-            total_bytes += data_size
-            for record in data_page:
-                game = record.pop('date')
-                dates = np.append(dates, game)
-    return np.unique(dates)
+    return sorted(iter_dates(seasons))
 
 if __name__ == "__main__":
-    seasons = np.arange(2014, 2023)
+    seasons = range(2014, 2023)
     dates = fetch_and_store_data(seasons)
     print(dates)
\ No newline at end of file
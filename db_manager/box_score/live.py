@@ -0,0 +1,186 @@
+import datetime
+import os
+import time
+from zoneinfo import ZoneInfo
+import numpy as np
+from dotenv import load_dotenv
+import database
+import checkpoint
+import dead_letter
+import metrics
+from api import API_ENDPOINT, fetch_fresh
+from process import parse_box_scores, payload_hash, loads, loaded_hashes
+from records import RecordBatch
+from dimensions import dimensions
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Game dates are local to the league, so "today" rolls over at midnight there rather than on the host
+LIVE_TIMEZONE = ZoneInfo(os.getenv("LIVE_TIMEZONE", "America/New_York"))
+
+# Stored payload hashes of the dates being polled, so a restart does not rewrite unchanged dates
+hashes_query = """
+SELECT date, payload_hash
+FROM ingest_checkpoint
+WHERE status = 'done' AND date = ANY(%s::date[]);
+"""
+
+def game_state(games):
+    # 'live' while any game is under way, 'final' once all are over, 'scheduled' before tip-off
+    if not games:
+        return 'empty'
+    final = [game['status'] == 'Final' for game in games]
+    if all(final):
+        return 'final'
+    if any(game.get('period') and not done for game, done in zip(games, final)):
+        return 'live'
+    return 'scheduled'
+
+def next_tip_off(games):
+    # Scheduled games carry their start time as the status, e.g. 2024-01-05T00:00:00Z
+    starts = []
+    for game in games:
+        try:
+            starts.append(datetime.datetime.fromisoformat(game['status'].replace('Z', '+00:00')).timestamp())
+        except (ValueError, AttributeError):
+            pass
+    return min(starts, default=None)
+
+class LiveDate:
+    # What was last committed for one polled date: its payload hash and a hash of every row by key,
+    # so a changed payload writes only the rows that changed
+    def __init__(self, date, digest=None):
+        self.date = date
+        self.digest = digest
+        self.rows = {table: {} for table in database.tables}
+        self.next_poll = 0.0
+        self.settled = False
+
+    def changed(self, batch):
+        key_columns = database.conflict_keys[batch.table]
+        positions = [list(batch.columns).index(column) for column in key_columns]
+        seen = self.rows[batch.table]
+        staged = {}
+        mask = np.zeros(len(batch), dtype=bool)
+        for i, row in enumerate(batch.rows()):
+            key = tuple(row[position] for position in positions)
+            row_hash = hash(row)
+            if seen.get(key) != row_hash and staged.get(key) != row_hash:
+                mask[i] = True
+                staged[key] = row_hash
+        return RecordBatch(batch.table, {name: column[mask] for name, column in batch.columns.items()}), staged
+
+    def remember(self, staged, digest):
+        for table, rows in staged.items():
+            self.rows[table].update(rows)
+        self.digest = digest
+
+class Live:
+    # Polls yesterday and today until stopped, as often as their games call for: every live_interval
+    # seconds while a game is on, at tip-off or every idle_interval seconds before, and every
+    # final_interval seconds once all are over, for stat corrections. Yesterday is dropped once it is
+    # final and a poll finds it unchanged.
+    def __init__(self, live_interval=15, idle_interval=600, final_interval=900):
+        self.live_interval = live_interval
+        self.idle_interval = idle_interval
+        self.final_interval = final_interval
+        self.conn = database.connect()
+        self.tracked = {}
+
+    def today(self):
+        return datetime.datetime.now(LIVE_TIMEZONE).date()
+
+    def track(self, today):
+        wanted = [today - datetime.timedelta(days=1), today]
+        for date in list(self.tracked):
+            if date not in wanted:
+                del self.tracked[date]
+        new_dates = [date for date in wanted if date not in self.tracked]
+        if not new_dates:
+            return
+        checkpoint.register(self.conn, new_dates)
+        with self.conn.cursor() as cur:
+            cur.execute(hashes_query, [[str(date) for date in new_dates]])
+            digests = {date: digest for date, digest in cur.fetchall()}
+        self.conn.commit()
+        for date in new_dates:
+            self.tracked[date] = LiveDate(date, digests.get(date))
+
+    def schedule(self, live_date, games, unchanged, today):
+        now = time.time()
+        state = game_state(games)
+        if state == 'live':
+            delay = self.live_interval
+        elif state == 'scheduled':
+            tip_off = next_tip_off(games)
+            delay = self.idle_interval if tip_off is None else min(self.idle_interval, max(tip_off - now, self.live_interval))
+        elif live_date.date < today and unchanged and state in ('final', 'empty'):
+            live_date.settled = True
+            return state
+        elif state == 'final':
+            delay = self.final_interval
+        else:
+            delay = self.idle_interval
+        live_date.next_poll = time.monotonic() + delay
+        return state
+
+    def poll(self, live_date, today):
+        date = live_date.date.isoformat()
+        try:
+            body = fetch_fresh({"date": date})
+            metrics.payload_bytes.inc(len(body), endpoint=API_ENDPOINT)
+            with metrics.parse_seconds.time():
+                data = loads(body)
+                digest = payload_hash(body)
+                records = parse_box_scores(data) if digest != live_date.digest else None
+        except Exception as e:
+            print(f"Error polling date {date}: {e}")
+            metrics.dates.inc(outcome='failed')
+            live_date.next_poll = time.monotonic() + self.live_interval
+            return
+        metrics.dates.inc(outcome='parsed')
+        state = self.schedule(live_date, data['data'], records is None, today)
+        if records is None:
+            metrics.dates.inc(outcome='unchanged')
+            return
+
+        changed, staged = zip(*(live_date.changed(batch) for batch in records))
+        try:
+            with metrics.write_seconds.time(mode='live'):
+                stats, dimension_keys = database.write_batches(self.conn, [changed], dimensions)
+                checkpoint.mark_done(self.conn, [(date, digest)])
+                dead_letter.resolve(self.conn, [date])
+                self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error writing date {date}: {e}")
+            metrics.dates.inc(outcome='write_failed')
+            live_date.next_poll = time.monotonic() + self.live_interval
+            return
+        dimensions.remember(dimension_keys)
+        database.record_stats(stats)
+        live_date.remember(dict(zip(database.tables, staged)), digest)
+        loaded_hashes[date] = digest
+        metrics.dates.inc(outcome='written')
+        print(f"{datetime.datetime.now():%H:%M:%S} {date} {state}: {len(changed[2])} player_game and {len(changed[1])} game rows changed")
+
+    def run(self):
+        try:
+            while True:
+                today = self.today()
+                self.track(today)
+                for live_date in list(self.tracked.values()):
+                    if not live_date.settled and live_date.next_poll <= time.monotonic():
+                        self.poll(live_date, today)
+                # Wake at least once a minute to notice midnight
+                pending = [live_date.next_poll for live_date in self.tracked.values() if not live_date.settled]
+                time.sleep(min([max(next_poll - time.monotonic(), 0) for next_poll in pending] + [60]))
+        finally:
+            self.conn.close()
+
+def run(live_interval=15, idle_interval=600, final_interval=900):
+    # Games and stat lines change while a game is on, so they are updated in place rather than skipped
+    database.merge()
+    print(f"Polling live box scores every {live_interval}s while games are on")
+    Live(live_interval, idle_interval, final_interval).run()
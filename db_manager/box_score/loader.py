@@ -0,0 +1,271 @@
+import glob
+import hashlib
+import os
+import struct
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+import database
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Where loaded frames are kept between runs, next to the API payload cache
+FRAME_CACHE_DIR = os.getenv("FRAME_CACHE_DIR", os.path.join(os.getenv("CACHE_DIR", ".cache"), "frames"))
+
+# Bytes of the COPY stream buffered before they are decoded
+CHUNK_BYTES = 8 << 20
+
+HEADER = b'PGCOPY\n\xff\r\n\x00'
+POSTGRES_EPOCH = np.datetime64('2000-01-01', 'us')
+
+# Fixed-width binary encodings by type OID: wire dtype, struct format and the NumPy dtype columns end up in
+fixed_types = {
+    16: ('u1', '?', np.bool_),
+    20: ('>i8', '>q', np.int64),
+    21: ('>i2', '>h', np.int16),
+    23: ('>i4', '>i', np.int32),
+    700: ('>f4', '>f', np.float32),
+    701: ('>f8', '>d', np.float64),
+    1082: ('>i4', '>i', 'datetime64[D]'),
+    1114: ('>i8', '>q', 'datetime64[us]'),
+    1184: ('>i8', '>q', 'datetime64[us]'),
+}
+text_types = {19, 25, 1042, 1043}
+NUMERIC = 1700
+
+# Tables with their own season column, and tables filtered by season through their games
+season_tables = {'game', 'player_game', 'game_aggregate', 'season_aggregate', 'rollup_cube', 'rollup_cube_game'}
+game_tables = {'team_game'}
+
+def decode_numeric(buffer, pos):
+    # Base-10000 digits with a weight and sign, as float
+    ndigits, weight, sign, _ = struct.unpack_from('>hhHh', buffer, pos)
+    if sign == 0xC000:
+        return np.nan
+    if sign in (0xD000, 0xF000):
+        return np.inf if sign == 0xD000 else -np.inf
+    value = 0
+    for digit in struct.unpack_from(f'>{ndigits}h', buffer, pos + 8):
+        value = value * 10000 + digit
+    value = value * 10000.0 ** (weight - ndigits + 1) if ndigits else 0.0
+    return -value if sign == 0x4000 else value
+
+def to_column(oid, values):
+    # Raw decoded values of one column to its final NumPy dtype
+    if oid in text_types:
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+    if oid == NUMERIC:
+        return np.asarray(values, dtype=np.float64)
+    values = np.asarray(values).astype(fixed_types[oid][0].replace('>', '='), copy=False)
+    if oid == 1082:
+        return np.datetime64('2000-01-01', 'D') + values.astype('timedelta64[D]')
+    if oid in (1114, 1184):
+        return POSTGRES_EPOCH + values.astype('timedelta64[us]')
+    return values.astype(fixed_types[oid][2], copy=False)
+
+def with_nulls(column, mask):
+    if not mask.any():
+        return column
+    if column.dtype.kind in 'iu':
+        column = column.astype(np.float64)
+    elif column.dtype.kind == 'b':
+        column = column.astype(object)
+    if column.dtype.kind == 'M':
+        column[mask] = np.datetime64('NaT')
+    elif column.dtype.kind == 'f':
+        column[mask] = np.nan
+    else:
+        column[mask] = None
+    return column
+
+class BinaryCopyDecoder:
+    # File-like sink for COPY ... TO STDOUT (FORMAT binary) that decodes the stream into columns chunk by chunk.
+    # When every column is fixed-width, runs of rows without nulls are read with one structured-dtype
+    # frombuffer call; rows with nulls and variable-width columns go through the row-by-row decoder.
+    def __init__(self, description, chunk_bytes=CHUNK_BYTES):
+        self.names = [column.name for column in description]
+        self.oids = [column.type_code for column in description]
+        for name, oid in zip(self.names, self.oids):
+            if oid not in fixed_types and oid not in text_types and oid != NUMERIC:
+                raise TypeError(f"Column {name} has unsupported type OID {oid}, cast it in the query")
+        self.chunk_bytes = chunk_bytes
+        self.buffer = bytearray()
+        self.pos = None
+        self.done = False
+        self.pieces = []  # Decoded runs of rows in stream order: ('columns', arrays) or ('rows', tuples)
+
+        self.row_dtype = None
+        if all(oid in fixed_types for oid in self.oids):
+            fields = [('count', '>i2')]
+            for i, oid in enumerate(self.oids):
+                fields += [(f'length{i}', '>i4'), (f'value{i}', fixed_types[oid][0])]
+            self.row_dtype = np.dtype(fields)
+            self.sizes = [np.dtype(fixed_types[oid][0]).itemsize for oid in self.oids]
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_bytes:
+            self.decode()
+        return len(data)
+
+    def decode(self):
+        if self.pos is None:
+            if len(self.buffer) < len(HEADER) + 8:
+                return
+            if bytes(self.buffer[:len(HEADER)]) != HEADER:
+                raise ValueError("Not a binary COPY stream")
+            (extension,) = struct.unpack_from('>i', self.buffer, len(HEADER) + 4)
+            self.pos = len(HEADER) + 8 + extension
+        while not self.done and (self.decode_fixed() or self.decode_row()):
+            pass
+        del self.buffer[:self.pos]
+        self.pos = 0
+
+    def decode_fixed(self):
+        if self.row_dtype is None:
+            return False
+        count = (len(self.buffer) - self.pos) // self.row_dtype.itemsize
+        if not count:
+            return False
+        rows = np.frombuffer(self.buffer, dtype=self.row_dtype, count=count, offset=self.pos)
+        valid = rows['count'] == len(self.oids)
+        for i, size in enumerate(self.sizes):
+            valid &= rows[f'length{i}'] == size
+        # Stop at the first row with a null (or the trailer) and leave it to decode_row
+        good = count if valid.all() else int(np.argmin(valid))
+        if good:
+            self.pieces.append(('columns', [to_column(oid, rows[f'value{i}'][:good]) for i, oid in enumerate(self.oids)]))
+            self.pos += good * self.row_dtype.itemsize
+        del rows
+        return good > 0
+
+    def decode_row(self):
+        buffer, pos = self.buffer, self.pos
+        if len(buffer) - pos < 2:
+            return False
+        (count,) = struct.unpack_from('>h', buffer, pos)
+        if count == -1:
+            self.done = True
+            self.pos = pos + 2
+            return False
+        pos += 2
+        values = []
+        for oid in self.oids:
+            if len(buffer) - pos < 4:
+                return False
+            (length,) = struct.unpack_from('>i', buffer, pos)
+            pos += 4
+            if length == -1:
+                values.append(None)
+                continue
+            if len(buffer) - pos < length:
+                return False
+            if oid in text_types:
+                values.append(bytes(buffer[pos:pos + length]).decode())
+            elif oid == NUMERIC:
+                values.append(decode_numeric(buffer, pos))
+            else:
+                values.append(struct.unpack_from(fixed_types[oid][1], buffer, pos)[0])
+            pos += length
+        if self.pieces and self.pieces[-1][0] == 'rows':
+            self.pieces[-1][1].append(values)
+        else:
+            self.pieces.append(('rows', [values]))
+        self.pos = pos
+        return True
+
+    def columns(self):
+        self.decode()
+        if not self.done:
+            raise ValueError("Binary COPY stream ended without a trailer")
+        parts = [[] for _ in self.oids]
+        masks = [[] for _ in self.oids]
+        for kind, piece in self.pieces:
+            for i, oid in enumerate(self.oids):
+                if kind == 'columns':
+                    parts[i].append(piece[i])
+                    masks[i].append(np.zeros(len(piece[i]), dtype=bool))
+                else:
+                    values = [row[i] for row in piece]
+                    mask = np.array([value is None for value in values], dtype=bool)
+                    if oid not in text_types:
+                        values = [np.nan if value is None and oid == NUMERIC else 0 if value is None else value for value in values]
+                    parts[i].append(to_column(oid, values))
+                    masks[i].append(mask)
+        columns = {}
+        for name, oid, part, mask in zip(self.names, self.oids, parts, masks):
+            if part:
+                columns[name] = with_nulls(np.concatenate(part), np.concatenate(mask))
+            else:
+                columns[name] = to_column(oid, [])
+        return columns
+
+def copy_columns(conn, query, chunk_bytes=CHUNK_BYTES):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT * FROM ({query}) AS projection LIMIT 0;")
+        decoder = BinaryCopyDecoder(cur.description, chunk_bytes)
+        cur.copy_expert(f"COPY ({query}) TO STDOUT (FORMAT binary);", decoder)
+    return decoder.columns()
+
+def table_query(table, columns=None, seasons=None):
+    query = f"SELECT {', '.join(columns) if columns else '*'} FROM {table}"
+    if seasons is None:
+        return query
+    season_list = ', '.join(str(int(season)) for season in sorted(seasons))
+    if table in season_tables:
+        return f"{query} WHERE season IN ({season_list})"
+    if table in game_tables:
+        return f"{query} WHERE game_id IN (SELECT game_id FROM game WHERE season IN ({season_list}))"
+    raise ValueError(f"Table {table} cannot be filtered by season")
+
+# Every write commits with its dates marked done in ingest_checkpoint, which stamps their updated_at,
+# so a load, merge or live update changes the sum of those stamps even when a transaction that started
+# earlier commits last. One row per date keeps this far cheaper than reading the fact tables.
+version_query = """
+SELECT count(*), max(updated_at), sum(extract(epoch FROM updated_at))
+FROM ingest_checkpoint;
+"""
+
+def data_version(conn):
+    with conn.cursor() as cur:
+        cur.execute(version_query)
+        version = cur.fetchone()
+    return hashlib.sha256(repr(version).encode()).hexdigest()[:16]
+
+def cached_frame(conn, query, cache=True):
+    # Results stay valid until the loaded data changes
+    if not cache:
+        return pd.DataFrame(copy_columns(conn, query))
+    key = hashlib.sha256(query.encode()).hexdigest()
+    path = os.path.join(FRAME_CACHE_DIR, f"{key}-{data_version(conn)}.pkl")
+    if os.path.exists(path):
+        return pd.read_pickle(path)
+
+    frame = pd.DataFrame(copy_columns(conn, query))
+    os.makedirs(FRAME_CACHE_DIR, exist_ok=True)
+    for stale_path in glob.glob(os.path.join(FRAME_CACHE_DIR, f"{key}-*.pkl")):
+        os.remove(stale_path)
+    tmp_path = f"{path}.tmp"
+    frame.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+    return frame
+
+def load_query(query, params=None, conn=None, cache=True):
+    # COPY takes no bind parameters, so they are inlined before the query is sent
+    own_conn = conn is None
+    conn = database.connect() if own_conn else conn
+    try:
+        if params is not None:
+            with conn.cursor() as cur:
+                query = cur.mogrify(query, params).decode()
+        return cached_frame(conn, query.strip().rstrip(';'), cache)
+    finally:
+        if own_conn:
+            conn.close()
+
+def load(table, columns=None, seasons=None, conn=None, cache=True):
+    # One table as a DataFrame, optionally projected to some columns and filtered to some seasons
+    return load_query(table_query(table, columns, seasons), conn=conn, cache=cache)
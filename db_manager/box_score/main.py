@@ -1,52 +1,187 @@
 import argparse
-from queue import Queue
-from threading import Thread
+import datetime
 from tqdm import tqdm
-from get_dates import fetch_and_store_data
-from process import worker, reprocess_error_dates, error_dates
-from database import close_connection
+from get_dates import iter_date_pages
+from paginate import DiscoveryError
+from process import run_workers, loaded_hashes, start_parse_pool, stop_parse_pool
+import database
+from database import close_connection, format_stats, load_stats
+from async_engine import run as run_async
+import cache
+import checkpoint
+import storage
+import metrics
+import distributed
+import dead_letter
+import live
+from dead_letter import dead_letters
+from client import API_KEY
+from rate_limit import limiter
+from dimensions import dimensions
 
 # Function to parse command-line arguments
 def parse_args():
     parser = argparse.ArgumentParser(description="NBA Data Loader")
-    parser.add_argument('--start_year', type=int, required=True, help='The start year of the date range')
-    parser.add_argument('--end_year', type=int, required=True, help='The end year of the date range')
+    parser.add_argument('--start_year', type=int, help='The start year of the date range')
+    parser.add_argument('--end_year', type=int, help='The end year of the date range')
     parser.add_argument('--num_workers', type=int, default=4, help='The number of worker threads')
-    return parser.parse_args()
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads', help='The ingest engine to use')
+    parser.add_argument('--concurrency', type=int, default=200, help='The maximum in-flight requests for the async engine')
+    parser.add_argument('--parse_processes', type=int, default=0, help='Processes that decode and parse payloads, 0 to parse on the fetch threads')
+    parser.add_argument('--replay', action='store_true', help='Rebuild from cached API payloads without any network calls')
+    parser.add_argument('--refetch', action='store_true', help='Fetch every payload again instead of reading it from the cache, e.g. to pick up stat corrections')
+    parser.add_argument('--merge', action='store_true', help='Update game and player_game rows whose contents changed instead of skipping them')
+    parser.add_argument('--backend', choices=list(storage.backends), default=database.backend_name, help='Where the box scores are stored')
+    parser.add_argument('--loader', choices=['copy', 'insert'], default='copy', help='How batches are written to the database')
+    parser.add_argument('--num_writers', type=int, default=1, help='The number of database writer threads')
+    parser.add_argument('--batch_rows', type=int, default=5000, help='Rows a writer coalesces before committing')
+    parser.add_argument('--flush_interval', type=float, default=5.0, help='Seconds a writer waits before committing a partial batch')
+    parser.add_argument('--write_queue_size', type=int, default=64, help='Parsed dates buffered before fetch workers block')
+    parser.add_argument('--resume', action='store_true', help='Only load dates that are not checkpointed as done')
+    parser.add_argument('--discovery_workers', type=int, default=8, help='Seasons whose games pages are crawled concurrently')
+    parser.add_argument('--warm_dimensions', action='store_true', help='Preload known players and player teams from the database')
+    parser.add_argument('--distributed', action='store_true', help='Claim dates from the shared ingest_checkpoint table, alongside workers on other hosts')
+    parser.add_argument('--no_discovery', action='store_true', help='With --distributed, only claim dates another worker discovers')
+    parser.add_argument('--lease_seconds', type=int, default=300, help='How long a claimed date stays leased without a heartbeat')
+    parser.add_argument('--claim_batch', type=int, default=16, help='Dates claimed per round trip with --distributed')
+    parser.add_argument('--max_attempts', type=int, default=5, help='Attempts before a failed date is left in dead_letter for good')
+    parser.add_argument('--retry_wait', type=float, default=300, help='Once every date is done, how long to keep waiting for retries that come due')
+    parser.add_argument('--live', action='store_true', help="Keep polling today's and yesterday's games and upsert what changes, instead of loading a date range")
+    parser.add_argument('--live_interval', type=float, default=15, help='With --live, seconds between polls while a game is on')
+    parser.add_argument('--idle_interval', type=float, default=600, help='With --live, longest wait between polls before tip-off or on a day without games')
+    parser.add_argument('--final_interval', type=float, default=900, help='With --live, seconds between polls for stat corrections once all games are final')
+    parser.add_argument('--metrics_port', type=int, help='Serve Prometheus metrics on this port at /metrics')
+    parser.add_argument('--metrics_file', help='Append a JSON snapshot of the metrics to this file every --metrics_interval seconds')
+    parser.add_argument('--metrics_interval', type=float, default=10.0, help='Seconds between JSON metrics snapshots')
+    args = parser.parse_args()
+    if not args.live and (args.start_year is None or args.end_year is None):
+        parser.error("--start_year and --end_year are required unless --live is given")
+    if args.replay and args.refetch:
+        parser.error("--replay reads every payload from the cache and cannot be combined with --refetch")
+    if args.live and (args.replay or args.distributed):
+        parser.error("--live polls the API itself and cannot be combined with --replay or --distributed")
+    return args
+
+def discover_dates(seasons, resume, discovery_workers, errors):
+    # Dates a previous run registered but never finished may sit behind a saved cursor
+    if resume:
+        new_dates = [date for date in checkpoint.unfinished(database.conn) if cache.season_of(datetime.date.fromisoformat(date)) in seasons]
+        yield from new_dates
+        seen = set(new_dates)
+    else:
+        seen = set()
+
+    try:
+        for new_dates, ack in iter_date_pages(seasons, discovery_workers, resume):
+            if new_dates:
+                checkpoint.register(database.conn, new_dates)
+            # Only now is the page's cursor saved, so --resume never passes dates that were never registered
+            ack()
+            for date in new_dates:
+                if date not in seen and not (resume and date in loaded_hashes):
+                    yield date
+    except DiscoveryError as e:
+        # The dates found so far are still loaded; the failed seasons pick up from their cursor on --resume
+        errors.append(e)
 
 def main():
     args = parse_args()
+    database.use(args.backend)
+    cache.replay = args.replay
+    cache.refetch = args.refetch
+    if args.merge:
+        # Unchanged payloads are still skipped by hash; changed ones write only the rows whose row_hash differs
+        database.merge()
+    database.loader = args.loader
+    database.configure(database.conn)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print(f"Serving metrics on port {args.metrics_port}")
+    sampler = metrics.start(args.metrics_file, args.metrics_interval)
 
-    # Create a queue and add dates
-    print('Getting dates...')
-    flattened_dates = fetch_and_store_data(range(args.start_year, args.end_year + 1))
-    queue = Queue()
-    for date in flattened_dates:
-        queue.put(date)
-
-    # Create and start threads
-    num_workers = args.num_workers
-    threads = []
-    with tqdm(total=len(flattened_dates)) as pbar:
-        for _ in range(num_workers):  # Number of worker threads
-            t = Thread(target=worker, args=(queue, pbar, num_workers))
-            t.start()
-            threads.append(t)
+    loaded_hashes.update(checkpoint.loaded(database.conn))
+    if args.warm_dimensions:
+        num_players, num_player_teams = dimensions.warm(database.conn)
+        print(f"Warmed dimension cache with {num_players} players and {num_player_teams} player teams")
+    if args.resume:
+        print(f"Resuming past {len(loaded_hashes)} loaded dates")
 
-        # Wait for all tasks in the queue to be processed
-        queue.join()
+    if args.live:
+        # Runs until interrupted
+        try:
+            live.run(args.live_interval, args.idle_interval, args.final_interval)
+        except KeyboardInterrupt:
+            pass
+        dead_letters.close()
+        close_connection()
+        sampler.stop()
+        print(f"Rows inserted/skipped: {format_stats(load_stats)}")
+        print(metrics.summary())
+        return
 
-        # Wait for all threads to finish
-        for t in threads:
-            t.join()
+    # Box scores start while dates are still being discovered
+    seasons = range(args.start_year, args.end_year + 1)
+    heartbeat = None
+    discovery_errors = []
+    if args.distributed:
+        if args.backend != 'postgres':
+            raise SystemExit("--distributed needs the postgres backend")
+        # Every worker using this API key draws from one request budget
+        limiter.share(distributed.SharedQuota(database.connect(), API_KEY))
+        discovery = None
+        if not args.no_discovery:
+            discovery = distributed.Discovery(iter_date_pages(seasons, args.discovery_workers, args.resume))
+            discovery.start()
+        heartbeat = distributed.Heartbeat(args.lease_seconds)
+        heartbeat.start()
+        # Failed dates are claimed again, by any worker, once their backoff is over
+        dates = distributed.claimed_dates(seasons, discovery, args.claim_batch, args.lease_seconds, args.max_attempts, args.retry_wait)
+        print(f"Claiming dates as {distributed.WORKER_ID}")
+    else:
+        # Failed dates are retried between new ones once their backoff is over
+        dates = dead_letter.with_retries(discover_dates(seasons, args.resume, args.discovery_workers, discovery_errors), seasons, args.max_attempts, args.retry_wait)
+    num_workers = args.num_workers
+    num_writers = args.num_writers
+    max_writers = database.get_backend().max_writers
+    if max_writers and num_writers > max_writers:
+        print(f"The {args.backend} backend supports {max_writers} writer(s), using {max_writers}")
+        num_writers = max_writers
+    writer_options = {
+        'num_writers': num_writers,
+        'batch_rows': args.batch_rows,
+        'flush_interval': args.flush_interval,
+        'queue_size': args.write_queue_size,
+    }
+    if args.parse_processes:
+        # JSON decoding and column building are CPU-bound, so they scale with processes rather than threads
+        start_parse_pool(args.parse_processes)
+    if args.engine == 'async':
+        # Keep many requests in flight on one event loop
+        with tqdm(total=0) as pbar:
+            run_async(dates, pbar, writer_options, concurrency=args.concurrency)
+    else:
+        run_workers(dates, num_workers, writer_options)
+    stop_parse_pool()
+    if heartbeat is not None:
+        heartbeat.stop()
+    if args.distributed and discovery is not None and discovery.error is not None:
+        discovery_errors.append(discovery.error)
 
-    # Reprocess dates that encountered errors
-    if error_dates:
-        print(f"Reprocessing {len(error_dates)} error dates...")
-        reprocess_error_dates(num_workers)
+    dead_letters.close()
+    failed = dead_letter.report(database.conn, seasons, args.max_attempts)
 
     # Close the connection
     close_connection()
+    sampler.stop()
+
+    print(f"Rows inserted/skipped: {format_stats(load_stats)}")
+    print(f"Dimension cache: {dimensions.report()}")
+    print(f"Dead letters: {failed}")
+    print(metrics.summary())
+    incomplete = [f"discovery stopped: {e}" for e in discovery_errors]
+    incomplete += [f"{date} failed and could not be recorded for retry: {e}" for date, e in dead_letters.unrecorded]
+    if incomplete:
+        raise SystemExit(f"Run incomplete, rerun with --resume to continue: {'; '.join(incomplete)}")
 
     print("------------------------------------")
     print("Done!")
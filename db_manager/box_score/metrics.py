@@ -0,0 +1,312 @@
+import json
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock, Event
+
+# Upper bounds in seconds of the latency buckets, from a cache hit to a stalled request
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Every metric in the order it is rendered
+registry = []
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def matching(self, labels):
+        # (label dict, value) of every series whose labels include the given ones
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            series = dict(zip(self.labels, key))
+            if all(series[name] == str(wanted) for name, wanted in labels.items()):
+                yield series, value
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self, **labels):
+        return sum(value for _, value in self.matching(labels))
+
+    def samples(self):
+        for series, value in self.matching({}):
+            yield self.name, series, value
+
+    def snapshot(self):
+        return {label_text(series): value for series, value in self.matching({})}
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.functions = {}
+        self.peaks = {}
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+            self.peaks[key] = max(self.peaks.get(key, value), value)
+
+    def track(self, function, **labels):
+        # Read function() whenever the gauge is sampled, e.g. a queue's qsize
+        with self.lock:
+            self.functions[self.key(labels)] = function
+
+    def untrack(self, **labels):
+        with self.lock:
+            self.functions.pop(self.key(labels), None)
+
+    def sample(self):
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            self.set(function(), **dict(zip(self.labels, key)))
+
+    def peak(self, **labels):
+        with self.lock:
+            return self.peaks.get(self.key(labels), 0)
+
+    def samples(self):
+        for series, value in self.matching({}):
+            yield self.name, series, value
+
+    def snapshot(self):
+        return {label_text(series): value for series, value in self.matching({})}
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def merged(self, labels):
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for _, (series_counts, series_sum, _) in self.matching(labels):
+            counts = [a + b for a, b in zip(counts, series_counts)]
+            total += series_sum
+        return counts, total
+
+    def count(self, **labels):
+        return sum(self.merged(labels)[0])
+
+    def sum(self, **labels):
+        return self.merged(labels)[1]
+
+    def quantile(self, q, **labels):
+        # Interpolated within the bucket holding the q-th observation, as Prometheus' histogram_quantile does
+        counts, _ = self.merged(labels)
+        rank = q * sum(counts)
+        if not rank:
+            return 0.0
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def samples(self):
+        for series, (counts, total, count) in self.matching({}):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", dict(series, le='+Inf' if bound == float('inf') else repr(bound)), cumulative
+            yield f"{self.name}_sum", series, total
+            yield f"{self.name}_count", series, count
+
+    def snapshot(self):
+        return {label_text(series): {'count': count, 'sum': round(total, 6),
+                                     'p50': round(self.quantile(0.5, **series), 6), 'p99': round(self.quantile(0.99, **series), 6)}
+                for series, (_, total, count) in self.matching({})}
+
+# API
+request_seconds = Histogram('box_score_request_seconds', 'API request latency including the response body', ['endpoint'])
+responses = Counter('box_score_responses_total', 'API responses by status, "error" when no response arrived', ['endpoint', 'status'])
+downloaded_bytes = Counter('box_score_downloaded_bytes_total', 'Response bytes downloaded from the API', ['endpoint'])
+retries = Counter('box_score_retries_total', 'API requests retried after a failure', ['endpoint'])
+batch_splits = Counter('box_score_batch_splits_total', 'Packed API requests refused as too large and split in half', ['endpoint'])
+limiter_wait_seconds = Histogram('box_score_rate_limit_wait_seconds', 'Time spent waiting on the rate limiter before a request')
+cache_lookups = Counter('box_score_cache_lookups_total', 'Payload cache lookups by result', ['endpoint', 'result'])
+payload_bytes = Counter('box_score_payload_bytes_total', 'Payload bytes processed, from the API or the cache', ['endpoint'])
+
+# Parsing
+parse_seconds = Histogram('box_score_parse_seconds', 'Time to decode and parse one date of box scores')
+dates = Counter('box_score_dates_total', 'Dates by outcome', ['outcome'])
+queue_depth = Gauge('box_score_queue_depth', 'Items waiting in a pipeline queue', ['queue'])
+queue_wait_seconds = Histogram('box_score_queue_wait_seconds', 'Time producers spent blocked on a full queue', ['queue'])
+
+# Database
+write_seconds = Histogram('box_score_write_seconds', 'Time to write and commit one group of dates', ['mode'])
+load_seconds = Histogram('box_score_load_seconds', 'Time to load one table of a group, or refresh a derived table', ['table'])
+rows = Counter('box_score_rows_total', 'Rows written per table', ['table', 'result'])
+
+def count_retry(endpoint):
+    # Tenacity before_sleep hook
+    def hook(retry_state):
+        retries.inc(endpoint=endpoint)
+    return hook
+
+def render():
+    # Prometheus text exposition format
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{label_text(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+started = time.monotonic()
+
+def snapshot():
+    return {
+        'timestamp': time.time(),
+        'elapsed': round(time.monotonic() - started, 3),
+        'metrics': {metric.name: metric.snapshot() for metric in registry},
+    }
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = render().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(snapshot()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(port):
+    # /metrics for Prometheus, /metrics.json for everything else, on a daemon thread
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class Sampler(Thread):
+    # Samples tracked gauges every half second and appends a JSON snapshot to path every interval seconds
+    def __init__(self, path=None, interval=10.0):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stopped = Event()
+
+    def run(self):
+        next_snapshot = time.monotonic() + self.interval
+        while not self.stopped.wait(0.5):
+            queue_depth.sample()
+            if self.path and time.monotonic() >= next_snapshot:
+                self.write()
+                next_snapshot = time.monotonic() + self.interval
+
+    def write(self):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(snapshot()) + '\n')
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if self.path:
+            self.write()
+
+def start(path=None, interval=10.0):
+    sampler = Sampler(path, interval)
+    sampler.start()
+    return sampler
+
+def milliseconds(seconds):
+    return f"{seconds * 1000:.1f}"
+
+def bottleneck():
+    # Where fetch workers spent their time: blocked on the writers, on the limiter, on the API or parsing
+    blocked = queue_wait_seconds.sum(queue='write')
+    limited = limiter_wait_seconds.sum()
+    requesting = request_seconds.sum()
+    parsing = parse_seconds.sum()
+    busy = blocked + limited + requesting + parsing
+    if not busy:
+        return None
+    if blocked / busy > 0.1:
+        return f"the database: fetch workers spent {blocked / busy:.0%} of their time blocked on a full write queue"
+    stage, seconds = max([('the rate limiter', limited), ('the API', requesting), ('the parser', parsing)], key=lambda item: item[1])
+    return f"{stage}: {seconds / busy:.0%} of fetch worker time"
+
+def summary():
+    elapsed = time.monotonic() - started
+    lines = [f"{'Stage':<24}{'count':>10}{'total s':>10}{'p50 ms':>10}{'p99 ms':>10}"]
+    stages = [(f"request {series['endpoint']}", request_seconds, series) for series, _ in request_seconds.matching({})]
+    stages += [("rate limiter wait", limiter_wait_seconds, {}), ("parse", parse_seconds, {})]
+    stages += [(f"write {series['mode']}", write_seconds, series) for series, _ in write_seconds.matching({})]
+    stages += [(f"  load {series['table']}", load_seconds, series) for series, _ in load_seconds.matching({})]
+    for name, histogram, labels in stages:
+        lines.append(f"{name:<24}{histogram.count(**labels):>10}{histogram.sum(**labels):>10.1f}"
+                     f"{milliseconds(histogram.quantile(0.5, **labels)):>10}{milliseconds(histogram.quantile(0.99, **labels)):>10}")
+
+    megabytes = downloaded_bytes.total() / 1024 ** 2
+    hits, lookups = cache_lookups.total(result='hit'), cache_lookups.total()
+    statuses = ', '.join(f"{status}: {responses.total(status=status)}" for status in sorted({series['status'] for series, _ in responses.matching({})}))
+    lines.append(f"Downloaded {megabytes:.1f} MB in {elapsed:.1f}s ({megabytes / elapsed:.2f} MB/s), cache hits {hits}/{lookups}")
+    lines.append(f"Responses: {statuses or 'none'}; retries: {retries.total()}; batch splits: {batch_splits.total()}")
+    outcomes = ', '.join(f"{series['outcome']}: {value}" for series, value in dates.matching({}))
+    lines.append(f"Dates: {outcomes or 'none'}")
+    lines.append(f"Rows written: {rows.total(result='inserted')} ({rows.total(result='inserted') / elapsed:.0f}/s), skipped: {rows.total(result='skipped')}")
+    peaks = ', '.join(f"{series['queue']}: {queue_depth.peak(**series)}" for series, _ in queue_depth.matching({}))
+    lines.append(f"Peak queue depth: {peaks or 'not sampled'}")
+    hint = bottleneck()
+    if hint:
+        lines.append(f"Mostly bound by {hint}")
+    return '\n'.join(lines)
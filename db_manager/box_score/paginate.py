@@ -0,0 +1,120 @@
+import json
+import os
+from cache import is_current_season
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from threading import Event, Lock
+from dotenv import load_dotenv
+from tqdm import tqdm
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Where unfinished cursor chains are remembered between runs
+CURSOR_STATE = os.getenv("CURSOR_STATE", ".cursors.json")
+
+# Pages each season's chain may fetch ahead of the consumer, so memory stays flat however far they get
+PAGES_AHEAD = int(os.getenv("PAGES_AHEAD", 4))
+
+# Marks the end of one season's chain
+DONE = object()
+
+# Saved in place of a cursor once a season that is over has been crawled to its end
+COMPLETE = True
+
+class DiscoveryError(Exception):
+    # Raised once every season has been drained if any season's chain stopped early
+    pass
+
+class CursorState:
+    # Last cursor reached per endpoint and season, so a failed chain resumes mid-way, or COMPLETE
+    def __init__(self, path=CURSOR_STATE, resume=True):
+        self.path = path
+        self.lock = Lock()
+        self.cursors = {}
+        if resume:
+            try:
+                with open(path) as f:
+                    self.cursors = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def get(self, key):
+        cursor = self.cursors.get(key)
+        return None if cursor is COMPLETE else cursor
+
+    def complete(self, key):
+        return self.cursors.get(key) is COMPLETE
+
+    def set(self, key, cursor):
+        with self.lock:
+            if cursor is None:
+                self.cursors.pop(key, None)
+            else:
+                self.cursors[key] = cursor
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.cursors, f)
+            os.replace(tmp_path, self.path)
+
+def put(pages, item, stopped):
+    # Blocks while the queue is full, giving up once the consumer has gone away
+    while not stopped.is_set():
+        try:
+            pages.put(item, timeout=0.5)
+            return True
+        except Full:
+            pass
+    return False
+
+def run_chain(fetch_season, endpoint, season, state, pages, stopped):
+    # Each page goes out with an ack that saves the cursor past it, called by the consumer once the
+    # page's dates are registered, so a resumed run never skips dates that were only buffered. The
+    # last page of a season that is over saves COMPLETE, so a resumed run skips the season; the current
+    # season keeps the cursor of its last page, where newly played games will appear.
+    key = f"{endpoint}:{season}"
+    if state.complete(key):
+        put(pages, (season, DONE), stopped)
+        return
+    finished = not is_current_season({"seasons[]": season})
+    cursor = state.get(key)
+    try:
+        for data_page, data_size, next_cursor in fetch_season(season, cursor):
+            saved = next_cursor if next_cursor else COMPLETE if finished else cursor
+            ack = lambda saved=saved: state.set(key, saved)
+            if not put(pages, (season, (data_page, data_size, ack)), stopped):
+                return
+            cursor = next_cursor
+        put(pages, (season, DONE), stopped)
+    except Exception as e:
+        put(pages, (season, DiscoveryError(f"{endpoint} season {season} stopped after cursor {cursor}: {e}")), stopped)
+
+def paginate_seasons(fetch_season, endpoint, seasons, max_workers=8, resume=False):
+    # Runs one cursor chain per season concurrently (every request still goes through the shared
+    # rate limiter) and yields (data_page, data_size, ack) from whichever season has a page ready.
+    # Seasons whose chain failed are raised together as a DiscoveryError once the others are drained.
+    state = CursorState(resume=resume)
+    seasons = list(seasons)
+    pages = Queue(maxsize=PAGES_AHEAD * min(max_workers, len(seasons) or 1))
+    stopped = Event()
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for season in seasons:
+            executor.submit(run_chain, fetch_season, endpoint, season, state, pages, stopped)
+        try:
+            running = len(seasons)
+            while running:
+                season, page = pages.get()
+                if page is DONE:
+                    running -= 1
+                elif isinstance(page, DiscoveryError):
+                    tqdm.write(str(page))
+                    errors.append(page)
+                    running -= 1
+                else:
+                    yield page
+        finally:
+            # Lets chains blocked on a full queue exit when the consumer stops early
+            stopped.set()
+    if errors:
+        raise DiscoveryError("; ".join(str(e) for e in errors))
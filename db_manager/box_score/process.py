@@ -1,13 +1,28 @@
-import time
 from queue import Queue, Empty
-from threading import Thread, Lock
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import multiprocessing
+from threading import Thread
 from tqdm import tqdm
-from api import make_request
-from database import batch_insert
-
-error_dates = []
-game_id_counter = 1
-counter_lock = Lock()
+import api
+import database
+from api import API_ENDPOINT, fetch_raw, fetch_dates
+from writer import start_writers, stop_writers
+from records import SCHEMA, RecordBatch, row_hashes
+from dead_letter import dead_letters
+import numpy as np
+import metrics
+
+# orjson decodes large payloads several times faster; plain json when it is not installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Payload hashes of dates already loaded, so unchanged payloads are not rewritten
+loaded_hashes = {}
 
 def none_to_zero(value):
     return 0 if value is None else value
@@ -15,103 +30,226 @@ def none_to_zero(value):
 def none_to_missing(value):
     return "missing" if value == '' else value
 
-def process_date(date):
-    global game_id_counter
+def payload_hash(body):
+    return hashlib.sha256(body).hexdigest()
+
+def minutes_played(value):
+    if value is None:
+        return 0
+    min_parts = value.split(":")
+    return int(min_parts[0]) + int(min_parts[1]) / 60 if len(min_parts) == 2 else 0
+
+def object_column(values):
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+def stat_column(entries, name, dtype):
+    # Nulls become NaN in a float array and are then stored as 0
+    values = np.array([entry[name] for entry in entries], dtype=np.float64)
+    return np.nan_to_num(values, nan=0.0, copy=False).astype(dtype, copy=False)
+
+def parse_box_scores(data):
+    games = data['data']
+
+    # One pass flattens the payload; every column is then built whole instead of row by row
+    entries = []
+    game_ids = []
+    team_ids = []
+    seasons = []
+    for game in games:
+        for team in ('home_team', 'visitor_team'):
+            team_players = game[team]['players']
+            entries.extend(team_players)
+            game_ids.extend([game['id']] * len(team_players))
+            team_ids.extend([game[team]['id']] * len(team_players))
+            seasons.extend([game['season']] * len(team_players))
+    infos = [entry['player'] for entry in entries]
+    player_ids = np.array([info['id'] for info in infos], dtype=np.int64)
+    game_ids = np.array(game_ids, dtype=np.int64)
+    team_ids = np.array(team_ids, dtype=np.int64)
+
+    players = {'player_id': player_ids}
+    for name, dtype in SCHEMA['player'][1:]:
+        if dtype is object:
+            players[name] = object_column([info[name] for info in infos])
+        else:
+            players[name] = stat_column(infos, name, dtype)
+
+    player_games = {'player_id': player_ids, 'game_id': game_ids,
+                    'min': np.array([minutes_played(entry['min']) for entry in entries], dtype=np.float64)}
+    for name, dtype in SCHEMA['player_game'][3:-3]:
+        player_games[name] = stat_column(entries, name, dtype)
+    player_games['season'] = np.array(seasons, dtype=np.int64)
+    player_games['team_id'] = team_ids
+    player_games['row_hash'] = row_hashes(list(player_games.values()))
+
+    # The API game id is a stable natural key across runs
+    game_columns = {
+        'game_id': np.array([game['id'] for game in games], dtype=np.int64),
+        'date': object_column([game['date'] for game in games]),
+        'season': np.array([game['season'] for game in games], dtype=np.int64),
+        'home_team_score': stat_column(games, 'home_team_score', np.int64),
+        'visitor_team_score': stat_column(games, 'visitor_team_score', np.int64),
+        'home_team_id': np.array([game['home_team']['id'] for game in games], dtype=np.int64),
+        'visitor_team_id': np.array([game['visitor_team']['id'] for game in games], dtype=np.int64),
+        'postseason': object_column([game.get('postseason') for game in games]),
+    }
+    game_columns['row_hash'] = row_hashes(list(game_columns.values()))
+    team_games = {
+        'team_id': np.array([game[team]['id'] for game in games for team in ('home_team', 'visitor_team')], dtype=np.int64),
+        'game_id': np.repeat(game_columns['game_id'], 2),
+    }
 
+    return (
+        RecordBatch('player', players),
+        RecordBatch('game', game_columns),
+        RecordBatch('player_game', player_games),
+        RecordBatch('player_team', {'player_id': player_ids, 'team_id': team_ids}),
+        RecordBatch('team_game', team_games),
+    )
+
+# Processes that parse payloads off the fetch threads, None to parse on the calling thread
+parse_pool = None
+
+def parse_payload(body):
+    # Raw response bytes to record batches and the payload hash; picklable both ways for the parse pool
+    return parse_box_scores(loads(body)), payload_hash(body)
+
+def start_parse_pool(processes):
+    global parse_pool
+    # Forked from a single-threaded fork server rather than from this process, whose fetch, writer and
+    # discovery threads may hold locks; the server imports the pipeline once so each child starts warm
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['__main__', 'process'])
+    parse_pool = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+def stop_parse_pool():
+    global parse_pool
+    if parse_pool is not None:
+        parse_pool.shutdown()
+        parse_pool = None
+
+def parse(body):
+    if parse_pool is None:
+        return parse_payload(body)
+    # The fetch thread waits without holding the GIL while a parse process does the work
+    return parse_pool.submit(parse_payload, body).result()
+
+def unchanged(date, digest):
+    # A merge compares every date row by row, since a stored hash may predate corrections that an
+    # earlier run without --merge skipped
+    return not database.merge_enabled() and loaded_hashes.get(date) == digest
+
+def record_failure(date, stage, error):
+    print(f"Error processing date {date}: {error}")
+    metrics.dates.inc(outcome='failed')
+    # The retry must rewrite the date even if its payload turns out unchanged
+    loaded_hashes.pop(date, None)
+    dead_letters.add(date, stage, error)
+
+def parse_date(date, body):
+    # body is the date's payload, or the exception that failed its fetch
+    stage = 'fetch'
+    try:
+        if isinstance(body, Exception):
+            raise body
+        metrics.payload_bytes.inc(len(body), endpoint=API_ENDPOINT)
+        stage = 'parse'
+        with metrics.parse_seconds.time():
+            records, digest = parse(body)
+        metrics.dates.inc(outcome='parsed')
+        return records, digest
+    except Exception as e:
+        record_failure(date, stage, e)
+        return None, None
+
+def process_date(date):
     params = {
         "date": date,
     }
     try:
-        data = make_request(params)
-        player_records = []
-        game_records = []
-        player_game_records = []
-        player_team_records = []
-        team_game_records = []
-
-        with counter_lock:
-            local_game_id = game_id_counter
-
-        for game in data['data']:
-            game_record = (
-                local_game_id, game['date'], game['season'], game['home_team_score'], 
-                game['visitor_team_score'], game['home_team']['id'], game['visitor_team']['id']
-            )
-            game_records.append(game_record)
-
-            for team in ['home_team', 'visitor_team']:
-                for player in game[team]['players']:
-                    player_record = (
-                        player['player']['id'], player['player']['first_name'], player['player']['last_name'], 
-                        player['player']['position'], player['player']['height'], player['player']['weight'], 
-                        player['player']['jersey_number'], player['player']['college'], player['player']['country'],
-                        none_to_zero(player['player']['draft_year']), none_to_zero(player['player']['draft_round']),none_to_zero(player['player']['draft_number'])
-                    )
-                    player_records.append(player_record)
-
-                    min_played = player['min']
-                    if min_played is None:
-                        min_played = 0
-                    else:
-                        min_parts = min_played.split(":")
-                        min_played = int(min_parts[0]) + int(min_parts[1]) / 60 if len(min_parts) == 2 else 0
-
-                    player_game_record = (
-                        player['player']['id'], local_game_id, min_played, 
-                        none_to_zero(player['fgm']), none_to_zero(player['fga']), none_to_zero(player['fg_pct']), none_to_zero(player['fg3m']), 
-                        none_to_zero(player['fg3a']), none_to_zero(player['fg3_pct']), none_to_zero(player['ftm']), none_to_zero(player['fta']), 
-                        none_to_zero(player['ft_pct']), none_to_zero(player['oreb']), none_to_zero(player['dreb']), none_to_zero(player['reb']), 
-                        none_to_zero(player['ast']), none_to_zero(player['stl']), none_to_zero(player['blk']), none_to_zero(player['turnover']), 
-                        none_to_zero(player['pf']), none_to_zero(player['pts'])
-                    )
-                    player_game_records.append(player_game_record)
-
-                    player_team_record = (player['player']['id'], game[team]['id'])
-                    player_team_records.append(player_team_record)
-
-                team_game_record = (game[team]['id'], local_game_id)
-                team_game_records.append(team_game_record)
-
-            with counter_lock:
-                game_id_counter += 1
-                local_game_id = game_id_counter
-        
-        return player_records, game_records, player_game_records, player_team_records, team_game_records
+        body = fetch_raw(params)
     except Exception as e:
-        print(f"Error processing date {date}: {e}")
-        error_dates.append(date)  # Add date to the error list
-        return [], [], [], [], []
-
-def worker(queue, progress_bar, num_workers):
-    while True:
+        body = e
+    return parse_date(date, body)
+
+def process_dates(dates):
+    # Several dates from as few requests as api.fetch_dates can pack them into
+    if len(dates) == 1:
+        return [process_date(dates[0])]
+    bodies = fetch_dates(dates)
+    return [parse_date(date, bodies[date]) for date in dates]
+
+def take(queue, limit):
+    # The next date plus up to limit - 1 more already waiting, so a batch never waits on discovery.
+    # Also tells whether the end of the stream was reached.
+    dates = []
+    date = queue.get()
+    while date is not None:
+        dates.append(date)
+        if len(dates) >= limit:
+            return dates, False
         try:
             date = queue.get_nowait()
-            player_records, game_records, player_game_records, player_team_records, team_game_records = process_date(date)
-            if player_records or game_records or player_game_records or player_team_records or team_game_records:
-                batch_insert(player_records, game_records, player_game_records, player_team_records, team_game_records)
-            queue.task_done()
-            progress_bar.update(1)
-            # Add a delay to respect the rate limit
-            time.sleep(1 / ((300 / 60) / num_workers)) # Makes at most 300 requests per minute.
         except Empty:
-            break
+            return dates, False
+    return dates, True
+
+def worker(queue, write_queue, progress_bar):
+    while True:
+        dates, stopped = take(queue, api.batch_limit)
+        try:
+            for date, (records, digest) in zip(dates, process_dates(dates) if dates else []):
+                if records is not None and not unchanged(date, digest):
+                    with metrics.queue_wait_seconds.time(queue='write'):
+                        write_queue.put((date, records, digest))  # Blocks while the writers are behind
+                elif records is not None:
+                    metrics.dates.inc(outcome='unchanged')
+                    dead_letters.settle([date])
+                progress_bar.update(1)
         except Exception as e:
             print(f"Error in worker: {e}")
+            dead_letters.settle(dates)
+        finally:
+            for _ in range(len(dates) + stopped):
+                queue.task_done()
+        if stopped:  # No more dates
+            break
 
-# Function to reprocess error dates
-def reprocess_error_dates(num_workers):
-    queue = Queue()
-    for date in error_dates:
-        queue.put(date)
-    
+def feed(dates, queue, progress_bar, num_workers):
+    # Enqueue dates as they are discovered, growing the progress bar with them
+    try:
+        for date in dates:
+            progress_bar.total += 1
+            progress_bar.refresh()
+            queue.put(date)
+    finally:
+        # Always release the workers, even if discovery fails
+        for _ in range(num_workers):
+            queue.put(None)
+
+def run_workers(dates, num_workers, writer_options, desc=None):
+    queue = Queue(maxsize=num_workers * 4)
+    write_queue, writers = start_writers(**writer_options)
+    metrics.queue_depth.track(queue.qsize, queue='dates')
     threads = []
-    with tqdm(total=len(error_dates), desc="Reprocessing errors") as pbar:
+    with tqdm(total=0, desc=desc) as pbar:
+        feeder = Thread(target=feed, args=(dates, queue, pbar, num_workers))
+        feeder.start()
         for _ in range(num_workers):  # Number of worker threads
-            t = Thread(target=worker, args=(queue, pbar, num_workers))
+            t = Thread(target=worker, args=(queue, write_queue, pbar))
             t.start()
             threads.append(t)
-        
+
+        # Wait for all dates to be discovered and processed
+        feeder.join()
         queue.join()
 
+        # Wait for all threads to finish
         for t in threads:
             t.join()
+
+        # Flush whatever the writers still hold
+        stop_writers(write_queue, writers)
+        metrics.queue_depth.untrack(queue='dates')
@@ -0,0 +1,149 @@
+import asyncio
+import fcntl
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from dotenv import load_dotenv
+import requests
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Status codes the API uses to tell us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+def parse_retry_after(value, default=10.0):
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+class TokenBucket:
+    # Refills at the configured quota; callers reserve a token and sleep for the returned delay.
+    # When state_path is set the bucket state lives in a locked file shared by every process on the host,
+    # and once share() is given a store (distributed.SharedQuota) it lives there, shared across hosts.
+    def __init__(self, requests_per_minute=300, capacity=None, state_path=None, min_fraction=0.1, recovery_steps=50):
+        self.target_rate = requests_per_minute / 60
+        self.min_rate = self.target_rate * min_fraction
+        self.recovery = (self.target_rate - self.min_rate) / recovery_steps
+        self.capacity = capacity if capacity is not None else max(1.0, self.target_rate)
+        self.state_path = state_path
+        self.shared = None
+        self.lock = Lock()
+        # Updates from the event loop run here, as a shared bucket blocks on a file lock or a database
+        # round trip; one thread suffices since updates are serialized by the lock anyway
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="limiter")
+        self.state = {
+            "tokens": self.capacity,
+            "updated": time.time(),
+            "paused_until": 0.0,
+            "rate": self.target_rate,
+        }
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            requests_per_minute=float(os.getenv("RATE_LIMIT_PER_MINUTE", 300)),
+            state_path=os.getenv("RATE_LIMIT_STATE"),
+        )
+
+    def share(self, store):
+        self.shared = store
+
+    def _update(self, fn):
+        # Apply fn to the bucket state under the thread lock (and the file lock when shared)
+        with self.lock:
+            if self.shared is not None:
+                return self.shared.update(fn, self.state)
+            if not self.state_path:
+                return fn(self.state)
+            with open(self.state_path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    raw = f.read()
+                    state = json.loads(raw) if raw else dict(self.state)
+                    result = fn(state)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                    return result
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _reserve(self, state):
+        now = time.time()
+        rate = state["rate"]
+        state["tokens"] = min(self.capacity, state["tokens"] + (now - state["updated"]) * rate)
+        state["updated"] = now
+        state["tokens"] -= 1
+        delay = max(state["paused_until"] - now, 0.0)
+        if state["tokens"] < 0:
+            delay = max(delay, -state["tokens"] / rate)
+        return delay
+
+    def reserve(self):
+        return self._update(self._reserve)
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    async def acquire_async(self):
+        # Only the sleep stays on the event loop
+        delay = await asyncio.get_running_loop().run_in_executor(self.executor, self.reserve)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def throttle(self, retry_after):
+        # Pause every caller until the server is ready again and halve the refill rate
+        def apply(state):
+            state["paused_until"] = max(state["paused_until"], time.time() + retry_after)
+            state["rate"] = max(self.min_rate, state["rate"] / 2)
+            state["tokens"] = min(state["tokens"], 0.0)
+        self._update(apply)
+
+    def success(self):
+        # Additively recover towards the configured quota
+        def apply(state):
+            state["rate"] = min(self.target_rate, state["rate"] + self.recovery)
+        if self.state["rate"] < self.target_rate or self.state_path or self.shared is not None:
+            self._update(apply)
+
+    def observe(self, status, headers):
+        if status in THROTTLE_STATUSES:
+            self.throttle(parse_retry_after(headers.get("Retry-After")))
+        elif status < 400:
+            self.success()
+
+    async def observe_async(self, status, headers):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.observe, status, headers)
+
+class wait_for_limiter:
+    # Tenacity wait: throttled responses already paused the shared bucket, so retry right away
+    # and let the bucket decide; anything else falls back to the given wait strategy.
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def __call__(self, retry_state):
+        exception = retry_state.outcome.exception()
+        if isinstance(exception, requests.exceptions.HTTPError) and exception.response is not None \
+                and exception.response.status_code in THROTTLE_STATUSES:
+            return 0
+        return self.fallback(retry_state)
+
+# Process-wide limiter shared by every call site
+limiter = TokenBucket.from_env()
@@ -0,0 +1,90 @@
+import hashlib
+import numpy as np
+
+# Column names and NumPy dtypes of every table the box-score pipeline writes, in load order
+SCHEMA = {
+    'player': [
+        ('player_id', np.int64), ('first_name', object), ('last_name', object), ('position', object),
+        ('height', object), ('weight', object), ('jersey_number', object), ('college', object), ('country', object),
+        ('draft_year', np.int64), ('draft_round', np.int64), ('draft_number', np.int64),
+    ],
+    'game': [
+        ('game_id', np.int64), ('date', object), ('season', np.int64), ('home_team_score', np.int64),
+        ('visitor_team_score', np.int64), ('home_team_id', np.int64), ('visitor_team_id', np.int64), ('postseason', object),
+        ('row_hash', np.int64),
+    ],
+    'player_game': [
+        ('player_id', np.int64), ('game_id', np.int64), ('min', np.float64),
+        ('fgm', np.int64), ('fga', np.int64), ('fg_pct', np.float64), ('fg3m', np.int64), ('fg3a', np.int64),
+        ('fg3_pct', np.float64), ('ftm', np.int64), ('fta', np.int64), ('ft_pct', np.float64), ('oreb', np.int64),
+        ('dreb', np.int64), ('reb', np.int64), ('ast', np.int64), ('stl', np.int64), ('blk', np.int64),
+        ('turnover', np.int64), ('pf', np.int64), ('pts', np.int64), ('season', np.int64),
+        ('team_id', np.int64), ('row_hash', np.int64),
+    ],
+    'player_team': [('player_id', np.int64), ('team_id', np.int64)],
+    'team_game': [('team_id', np.int64), ('game_id', np.int64)],
+}
+
+# Fact tables whose last column hashes the others, so a changed row is told apart without comparing every column
+hashed_tables = {'game', 'player_game'}
+
+# Increment and multipliers of splitmix64, whose finalizer spreads every input bit over the whole hash
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX2 = np.uint64(0x94D049BB133111EB)
+
+def mix(h):
+    h = (h ^ (h >> np.uint64(30))) * MIX1
+    h = (h ^ (h >> np.uint64(27))) * MIX2
+    return h ^ (h >> np.uint64(31))
+
+def text_hashes(values):
+    return np.array([int.from_bytes(hashlib.blake2b(str(v).encode(), digest_size=8).digest(), 'little') for v in values], dtype=np.uint64)
+
+def row_hashes(columns):
+    # 64-bit hash of each row across the given columns, the same in every process and run unlike hash(),
+    # as the signed integer a BIGINT column stores
+    h = np.zeros(len(columns[0]), dtype=np.uint64)
+    for column in columns:
+        values = text_hashes(column) if column.dtype == object else np.ascontiguousarray(column).view(np.uint64)
+        h = mix((h ^ values) + GOLDEN)
+    return h.view(np.int64)
+
+def copy_text(values):
+    # Encode an object column for COPY's text format
+    return ['\\N' if v is None else str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+            for v in values]
+
+class RecordBatch:
+    # One table's rows held as typed column arrays
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+
+    @classmethod
+    def allocate(cls, table, size):
+        return cls(table, {name: np.zeros(size, dtype=dtype) if dtype is not object else np.full(size, None, dtype=object)
+                           for name, dtype in SCHEMA[table]})
+
+    @classmethod
+    def concat(cls, table, batches):
+        batches = [batch for batch in batches if len(batch)]
+        if len(batches) == 1:
+            return batches[0]
+        if not batches:
+            return cls.allocate(table, 0)
+        return cls(table, {name: np.concatenate([batch.columns[name] for batch in batches]) for name, _ in SCHEMA[table]})
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def rows(self):
+        return zip(*(column.tolist() for column in self.columns.values()))
+
+    def to_copy(self):
+        # Tab-separated text for COPY FROM STDIN, built column by column
+        encoded = [copy_text(column) if column.dtype == object else map(str, column.tolist()) for column in self.columns.values()]
+        return ''.join(line + '\n' for line in map('\t'.join, zip(*encoded)))
+
+    def to_dict(self):
+        return dict(self.columns)
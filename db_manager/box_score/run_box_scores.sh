@@ -7,16 +7,26 @@ export $(grep -v '^#' .env | xargs)
 START_YEAR=2014
 END_YEAR=2023
 NUM_WORKERS=4
+ENGINE=threads
+REPLAY=""
+BACKEND=${DB_BACKEND:-postgres}
+METRICS=""
+LIVE=""
 
 # Check for command-line arguments and override default date range if provided
-while getopts s:e:w: flag
+while getopts s:e:w:g:rb:m:l flag
 do
     case "${flag}" in
         s) START_YEAR=${OPTARG};;
         e) END_YEAR=${OPTARG};;
         w) NUM_WORKERS=${OPTARG};;
+        g) ENGINE=${OPTARG};;
+        r) REPLAY="--replay";;
+        b) BACKEND=${OPTARG};;
+        m) METRICS="--metrics_port ${OPTARG}";;
+        l) LIVE="--live";;
     esac
 done
 
-# Run the Python script with the provided date range and number of workers
-python main.py --start_year $START_YEAR --end_year $END_YEAR --num_workers $NUM_WORKERS
+# Run the Python script with the provided date range, number of workers, engine and storage backend
+python main.py --start_year $START_YEAR --end_year $END_YEAR --num_workers $NUM_WORKERS --engine $ENGINE --backend $BACKEND $REPLAY $METRICS $LIVE
@@ -0,0 +1,276 @@
+import io
+import os
+from threading import Lock
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+from records import SCHEMA
+import aggregates
+import cube
+import database
+
+# Load environment variables from .env file
+load_dotenv()
+
+class Backend:
+    # What the pipeline needs from a database: connections whose cursors share one transaction,
+    # a set-based upsert of one table's RecordBatch, and multi-row VALUES inserts for the checkpoint.
+    # load returns the number of rows written and, given a set, adds the game_id of each to it.
+    name = None
+    # Whether game_aggregate/season_aggregate and rollup_cube can be maintained on write
+    derived_tables = False
+    # Writers that can commit concurrently without conflicting, None for no limit
+    max_writers = None
+
+    def connect(self):
+        raise NotImplementedError
+
+    def configure(self, conn):
+        raise NotImplementedError
+
+    def load(self, cursor, table, batch, written=None):
+        raise NotImplementedError
+
+    def execute_values(self, cursor, query, rows, template=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class PostgresBackend(Backend):
+    name = 'postgres'
+    derived_tables = True
+
+    def __init__(self):
+        # Database connection details
+        self.conn_str = (f"dbname=box_scores user={os.getenv('DB_USER')} " +
+                         f"password={os.getenv('DB_PASS')} host={os.getenv('DB_HOST')} " +
+                         f"port={os.getenv('DB_PORT')}")
+
+    def connect(self):
+        return psycopg2.connect(self.conn_str)
+
+    def configure(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT EXISTS (SELECT FROM pg_partitioned_table WHERE partrelid = to_regclass('game'));")
+            partitioned = cur.fetchone()[0]
+        database.set_layout(partitioned)
+        database.maintain_aggregates = aggregates.available(conn)
+        database.maintain_cube = cube.available(conn)
+        if partitioned:
+            print("Loading into season-partitioned tables")
+        if not database.maintain_aggregates:
+            print("Aggregate tables not found, run create_db.py to keep season averages up to date")
+        if not database.maintain_cube:
+            print("Rollup cube tables not found, run create_db.py to keep the cube up to date")
+
+    def load(self, cursor, table, batch, written=None):
+        if database.loader == 'copy':
+            return self.copy_records(cursor, table, batch, written)
+        if written is not None:
+            # executemany keeps no RETURNING rows, so every game in the batch counts as written
+            written.update(batch.columns['game_id'].tolist())
+        return self.insert_records(cursor, table, batch)
+
+    def copy_records(self, cursor, table, batch, written=None):
+        columns, key = database.tables[table]
+        column_list = ', '.join(columns)
+        key_list = ', '.join(key)
+        stage = f"{table}_stage"
+
+        # Temporary tables are unlogged and private to this connection, so concurrent loaders never share a stage
+        cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {stage} (LIKE {table} INCLUDING DEFAULTS, stage_seq BIGINT GENERATED ALWAYS AS IDENTITY) ON COMMIT DELETE ROWS;")
+        buffer = io.StringIO(batch.to_copy())
+        cursor.copy_expert(f"COPY {stage} ({column_list}) FROM STDIN;", buffer)
+
+        # One set-based upsert per table, deduplicating rows repeated within the batch; the last staged
+        # copy of a key wins, so an updated row is never replaced by an older one from the same batch
+        returning = "" if written is None else "RETURNING game_id"
+        cursor.execute(f"""
+            INSERT INTO {table} ({column_list})
+            SELECT DISTINCT ON ({key_list}) {column_list} FROM {stage}
+            ORDER BY {key_list}, stage_seq DESC
+            ON CONFLICT ({key_list}) {database.conflict_action(table)}
+            {returning};
+        """)
+        if written is not None:
+            written.update(game_id for (game_id,) in cursor.fetchall())
+        return cursor.rowcount
+
+    def insert_query(self, table):
+        columns, key = database.tables[table]
+        return f"""
+            INSERT INTO {table} ({', '.join(columns)})
+            VALUES ({', '.join(['%s'] * len(columns))})
+            ON CONFLICT ({', '.join(key)}) {database.conflict_action(table)};
+        """
+
+    def insert_records(self, cursor, table, batch):
+        cursor.executemany(self.insert_query(table), batch.rows())
+        return cursor.rowcount
+
+    def execute_values(self, cursor, query, rows, template=None):
+        execute_values(cursor, query, rows, template=template)
+
+# Column types of the embedded schema; everything not listed follows its NumPy dtype
+duckdb_types = {np.int64: 'INTEGER', np.float64: 'DOUBLE', object: 'VARCHAR'}
+duckdb_overrides = {('game', 'date'): 'DATE', ('game', 'postseason'): 'BOOLEAN',
+                    ('game', 'row_hash'): 'BIGINT', ('player_game', 'row_hash'): 'BIGINT'}
+
+duckdb_extra_tables = """
+CREATE TABLE IF NOT EXISTS team (
+    team_id INTEGER PRIMARY KEY,
+    conference VARCHAR,
+    division VARCHAR,
+    city VARCHAR,
+    name VARCHAR,
+    full_name VARCHAR,
+    abbreviation VARCHAR
+);
+CREATE TABLE IF NOT EXISTS ingest_checkpoint (
+    date DATE PRIMARY KEY,
+    status VARCHAR NOT NULL DEFAULT 'pending',
+    payload_hash VARCHAR,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT now(),
+    leased_by VARCHAR,
+    lease_until TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS dead_letter (
+    date DATE PRIMARY KEY,
+    stage VARCHAR NOT NULL,
+    error_class VARCHAR NOT NULL,
+    error VARCHAR,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    first_failed_at TIMESTAMP NOT NULL DEFAULT now(),
+    last_failed_at TIMESTAMP NOT NULL DEFAULT now(),
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT now()
+);
+ALTER TABLE ingest_checkpoint ADD COLUMN IF NOT EXISTS leased_by VARCHAR;
+ALTER TABLE ingest_checkpoint ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP;
+ALTER TABLE game ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+ALTER TABLE player_game ADD COLUMN IF NOT EXISTS row_hash BIGINT;
+"""
+
+def duckdb_schema():
+    statements = []
+    for table, (columns, key) in database.tables.items():
+        definitions = [f"{name} {duckdb_overrides.get((table, name), duckdb_types[dtype])}" for name, dtype in SCHEMA[table]]
+        statements.append(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(definitions)}, PRIMARY KEY ({', '.join(key)}));")
+    return '\n'.join(statements) + duckdb_extra_tables
+
+class DuckDBCursor:
+    # psycopg2-style cursor over a DuckDB connection; the first statement opens the connection's transaction
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, query, params=None):
+        self.connection.begin()
+        result = self.connection.duck.execute(query.replace('%s', '?'), params or [])
+        self.description = result.description
+        return self
+
+    def executemany(self, query, rows):
+        self.connection.begin()
+        self.connection.duck.executemany(query.replace('%s', '?'), list(rows))
+
+    def fetchone(self):
+        return self.connection.duck.fetchone()
+
+    def fetchall(self):
+        return self.connection.duck.fetchall()
+
+    def close(self):
+        pass
+
+class DuckDBConnection:
+    # One DuckDB connection (a cursor of the shared database) with explicit commit and rollback, like psycopg2
+    def __init__(self, duck):
+        self.duck = duck
+        self.in_transaction = False
+
+    def cursor(self):
+        return DuckDBCursor(self)
+
+    def begin(self):
+        if not self.in_transaction:
+            self.duck.begin()
+            self.in_transaction = True
+
+    def commit(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.duck.commit()
+
+    def rollback(self):
+        if self.in_transaction:
+            self.in_transaction = False
+            self.duck.rollback()
+
+    def close(self):
+        self.rollback()
+        self.duck.close()
+
+class DuckDBBackend(Backend):
+    # Embedded, in-process columnar database: ingest and query.sql rollups without a server
+    name = 'duckdb'
+    # DuckDB's optimistic concurrency aborts one of two transactions upserting the same rows
+    max_writers = 1
+
+    def __init__(self):
+        import duckdb
+        self.path = os.getenv("DUCKDB_PATH", "box_scores.duckdb")
+        self.database = duckdb.connect(self.path)
+        self.lock = Lock()
+
+    def connect(self):
+        with self.lock:
+            return DuckDBConnection(self.database.cursor())
+
+    def configure(self, conn):
+        conn.duck.execute(duckdb_schema())
+        database.maintain_aggregates = database.maintain_cube = False
+        print(f"Loading into embedded DuckDB database {self.path}")
+
+    def load(self, cursor, table, batch, written=None):
+        # No derived tables to refresh here, so written game ids are not collected
+        columns, key = database.tables[table]
+        column_list = ', '.join(columns)
+        key_list = ', '.join(key)
+        stage = f"{table}_stage"
+
+        # The batch's arrays are scanned in place through a registered DataFrame, numbered so the last
+        # copy of a repeated key wins
+        frame = pd.DataFrame(batch.columns, columns=columns).assign(stage_seq=np.arange(len(batch)))
+        cursor.connection.duck.register(stage, frame)
+        try:
+            cursor.execute(f"""
+                INSERT INTO {table} ({column_list})
+                SELECT DISTINCT ON ({key_list}) {column_list} FROM {stage}
+                ORDER BY {key_list}, stage_seq DESC
+                ON CONFLICT ({key_list}) {database.conflict_action(table)};
+            """)
+            return cursor.fetchone()[0]
+        finally:
+            cursor.connection.duck.unregister(stage)
+
+    def execute_values(self, cursor, query, rows, template=None):
+        rows = list(rows)
+        if not rows:
+            return
+        template = template or f"({', '.join(['%s'] * len(rows[0]))})"
+        cursor.executemany(query.replace('VALUES %s', f"VALUES {template}"), rows)
+
+    def close(self):
+        self.database.close()
+
+backends = {'postgres': PostgresBackend, 'duckdb': DuckDBBackend}
@@ -0,0 +1,110 @@
+import time
+from queue import Queue, Empty
+from threading import Thread
+from tqdm import tqdm
+import database
+import checkpoint
+import dead_letter
+from dead_letter import dead_letters
+from dimensions import dimensions
+import metrics
+
+# Marks the end of the stream for one writer
+STOP = None
+
+# Seconds between checks for the end of the stream while a writer holds uncommitted dates
+DRAIN_POLL = 0.1
+
+def count_rows(records):
+    return sum(len(table_records) for table_records in records)
+
+class Writer(Thread):
+    # Drains parsed (date, records, payload_hash) batches and commits them in groups of batch_rows rows
+    # or every flush_interval seconds, whichever comes first, on its own connection.
+    def __init__(self, write_queue, batch_rows=5000, flush_interval=5.0):
+        super().__init__(daemon=True)
+        self.write_queue = write_queue
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.pending_rows = 0
+
+    def run(self):
+        self.conn = database.connect()
+        try:
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                timeout = max(deadline - time.monotonic(), 0.01)
+                if self.pending:
+                    timeout = min(timeout, DRAIN_POLL)
+                try:
+                    item = self.write_queue.get(timeout=timeout)
+                except Empty:
+                    item = ()
+                if item is STOP:
+                    self.flush()
+                    self.write_queue.task_done()
+                    break
+                if item:
+                    self.pending.append(item)
+                    self.pending_rows += count_rows(item[1])
+                    self.write_queue.task_done()
+                # Once the stream has run out, nothing more is coming to fill the batch
+                draining = dead_letters.draining.is_set() and self.write_queue.empty()
+                if self.pending_rows >= self.batch_rows or time.monotonic() >= deadline or draining:
+                    self.flush()
+                    deadline = time.monotonic() + self.flush_interval
+        finally:
+            self.conn.close()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending, self.pending_rows = self.pending, [], 0
+        try:
+            with metrics.write_seconds.time(mode='batch'):
+                stats, staged = database.write_batches(self.conn, [records for _, records, _ in pending], dimensions)
+                checkpoint.mark_done(self.conn, [(date, digest) for date, _, digest in pending])
+                dead_letter.resolve(self.conn, [date for date, _, _ in pending])
+                self.conn.commit()
+            dimensions.remember(staged)
+            database.record_stats(stats)
+            metrics.dates.inc(len(pending), outcome='written')
+        except Exception as e:
+            self.conn.rollback()
+            tqdm.write(f"Error writing {len(pending)} dates together, retrying one at a time: {e}")
+            self.flush_each(pending)
+
+    def flush_each(self, pending):
+        # Isolate the bad date so the rest of the group still lands
+        for date, records, digest in pending:
+            try:
+                with metrics.write_seconds.time(mode='single'):
+                    stats, staged = database.write_batches(self.conn, [records], dimensions)
+                    checkpoint.mark_done(self.conn, [(date, digest)])
+                    dead_letter.resolve(self.conn, [date])
+                    self.conn.commit()
+                dimensions.remember(staged)
+                database.record_stats(stats)
+                metrics.dates.inc(outcome='written')
+            except Exception as e:
+                self.conn.rollback()
+                tqdm.write(f"Error writing date {date}: {e}")
+                metrics.dates.inc(outcome='write_failed')
+                dead_letters.add(date, 'write', e)
+
+def start_writers(num_writers=1, batch_rows=5000, flush_interval=5.0, queue_size=64):
+    # The bounded queue applies backpressure to the fetch workers when the database falls behind
+    write_queue = Queue(maxsize=queue_size)
+    metrics.queue_depth.track(write_queue.qsize, queue='write')
+    writers = [Writer(write_queue, batch_rows, flush_interval) for _ in range(num_writers)]
+    for w in writers:
+        w.start()
+    return write_queue, writers
+
+def stop_writers(write_queue, writers):
+    for _ in writers:
+        write_queue.put(STOP)
+    for w in writers:
+        w.join()
+    metrics.queue_depth.untrack(queue='write')
@@ -1,3 +1,5 @@
+import argparse
+import datetime
 import os
 from dotenv import load_dotenv
 import psycopg2
@@ -6,6 +8,16 @@ from psycopg2 import sql
 # Load environment variables from .env
 load_dotenv()
 
+# Command-line options
+parser = argparse.ArgumentParser(description="Create the box_scores database")
+parser.add_argument('--partitioned', action='store_true', help='Partition game and player_game by season')
+parser.add_argument('--migrate', action='store_true', help='Move existing game and player_game rows into the partitioned layout')
+args = parser.parse_args()
+
+# Seasons that get their own partition; anything else lands in the default partition
+FIRST_SEASON = 1946
+LAST_SEASON = datetime.date.today().year + 1
+
 # PostgreSQL connection details
 admin_conn_str = f"dbname=postgres user={os.getenv('DB_USER')} password={os.getenv('DB_PASSWORD')} host={os.getenv('DB_HOST')} port={os.getenv('DB_PORT')}"
 
@@ -73,6 +85,8 @@ CREATE TABLE IF NOT EXISTS game (
     visitor_team_score INT,
     home_team_id INT,
     visitor_team_id INT,
+    postseason BOOLEAN,
+    row_hash BIGINT,
     FOREIGN KEY (home_team_id) REFERENCES team (team_id),
     FOREIGN KEY (visitor_team_id) REFERENCES team (team_id)
 );
@@ -101,6 +115,9 @@ CREATE TABLE IF NOT EXISTS player_game (
     turnover INT,
     pf INT,
     pts INT,
+    season INT,
+    team_id INT,
+    row_hash BIGINT,
     PRIMARY KEY (player_id, game_id),
     FOREIGN KEY (player_id) REFERENCES player (player_id),
     FOREIGN KEY (game_id) REFERENCES game (game_id)
@@ -127,6 +144,307 @@ CREATE TABLE IF NOT EXISTS team_game (
 );
 """
 
+create_ingest_checkpoint_table = """
+CREATE TABLE IF NOT EXISTS ingest_checkpoint (
+    date DATE PRIMARY KEY,
+    status VARCHAR(10) NOT NULL DEFAULT 'pending',
+    payload_hash CHAR(64),
+    attempts INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT now(),
+    leased_by VARCHAR(100),
+    lease_until TIMESTAMP
+);
+"""
+
+# Dates that failed to load, with why, how often and when they are next retried
+create_dead_letter_table = """
+CREATE TABLE IF NOT EXISTS dead_letter (
+    date DATE PRIMARY KEY,
+    stage VARCHAR(10) NOT NULL,
+    error_class VARCHAR(100) NOT NULL,
+    error TEXT,
+    attempts INT NOT NULL DEFAULT 1,
+    first_failed_at TIMESTAMP NOT NULL DEFAULT now(),
+    last_failed_at TIMESTAMP NOT NULL DEFAULT now(),
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS dead_letter_next_attempt_idx ON dead_letter (next_attempt_at);
+"""
+
+# Token bucket of each API key, shared by every distributed worker; times are epoch seconds on the database clock
+create_api_quota_table = """
+CREATE TABLE IF NOT EXISTS api_quota (
+    api_key_hash CHAR(64) PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated DOUBLE PRECISION NOT NULL,
+    paused_until DOUBLE PRECISION NOT NULL,
+    rate DOUBLE PRECISION NOT NULL
+);
+"""
+
+# Running per-game sums and counts of player_game, and per-season sums of the per-game averages,
+# kept up to date by the loader so the yearly averages in query.sql never rescan player_game
+create_game_aggregate_table = """
+CREATE TABLE IF NOT EXISTS game_aggregate (
+    game_id INT PRIMARY KEY,
+    season INT,
+    home_team_score INT,
+    visitor_team_score INT,
+    fgm_sum BIGINT,
+    fgm_count INT,
+    fga_sum BIGINT,
+    fga_count INT,
+    fg3m_sum BIGINT,
+    fg3m_count INT,
+    fg3a_sum BIGINT,
+    fg3a_count INT,
+    ftm_sum BIGINT,
+    ftm_count INT,
+    fta_sum BIGINT,
+    fta_count INT,
+    reb_sum BIGINT,
+    reb_count INT,
+    ast_sum BIGINT,
+    ast_count INT,
+    stl_sum BIGINT,
+    stl_count INT,
+    blk_sum BIGINT,
+    blk_count INT,
+    turnover_sum BIGINT,
+    turnover_count INT,
+    pf_sum BIGINT,
+    pf_count INT,
+    pts_sum BIGINT,
+    pts_count INT,
+    updated_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS game_aggregate_season_idx ON game_aggregate (season);
+"""
+
+create_season_aggregate_table = """
+CREATE TABLE IF NOT EXISTS season_aggregate (
+    season INT PRIMARY KEY,
+    games INT,
+    home_team_score_sum BIGINT,
+    home_team_score_count INT,
+    visitor_team_score_sum BIGINT,
+    visitor_team_score_count INT,
+    fgm_sum NUMERIC,
+    fgm_count INT,
+    fga_sum NUMERIC,
+    fga_count INT,
+    fg3m_sum NUMERIC,
+    fg3m_count INT,
+    fg3a_sum NUMERIC,
+    fg3a_count INT,
+    ftm_sum NUMERIC,
+    ftm_count INT,
+    fta_sum NUMERIC,
+    fta_count INT,
+    reb_sum NUMERIC,
+    reb_count INT,
+    ast_sum NUMERIC,
+    ast_count INT,
+    stl_sum NUMERIC,
+    stl_count INT,
+    blk_sum NUMERIC,
+    blk_count INT,
+    turnover_sum NUMERIC,
+    turnover_count INT,
+    pf_sum NUMERIC,
+    pf_count INT,
+    pts_sum NUMERIC,
+    pts_count INT,
+    updated_at TIMESTAMPTZ DEFAULT now()
+);
+"""
+
+# Rollup cube of player_game sums by season, team, position and postseason. rollup_cube_game holds
+# each game's contribution, so a reloaded game is retracted from the cube before it is applied again.
+create_rollup_cube_game_table = """
+CREATE TABLE IF NOT EXISTS rollup_cube_game (
+    game_id INT,
+    season INT NOT NULL,
+    team_id INT NOT NULL,
+    position VARCHAR(10) NOT NULL,
+    postseason BOOLEAN NOT NULL,
+    player_games INT,
+    min DOUBLE PRECISION,
+    fgm BIGINT,
+    fga BIGINT,
+    fg3m BIGINT,
+    fg3a BIGINT,
+    ftm BIGINT,
+    fta BIGINT,
+    oreb BIGINT,
+    dreb BIGINT,
+    reb BIGINT,
+    ast BIGINT,
+    stl BIGINT,
+    blk BIGINT,
+    turnover BIGINT,
+    pf BIGINT,
+    pts BIGINT,
+    PRIMARY KEY (game_id, team_id, position)
+);
+"""
+
+create_rollup_cube_table = """
+CREATE TABLE IF NOT EXISTS rollup_cube (
+    season INT,
+    team_id INT,
+    position VARCHAR(10),
+    postseason BOOLEAN,
+    player_games BIGINT,
+    min DOUBLE PRECISION,
+    fgm BIGINT,
+    fga BIGINT,
+    fg3m BIGINT,
+    fg3a BIGINT,
+    ftm BIGINT,
+    fta BIGINT,
+    oreb BIGINT,
+    dreb BIGINT,
+    reb BIGINT,
+    ast BIGINT,
+    stl BIGINT,
+    blk BIGINT,
+    turnover BIGINT,
+    pf BIGINT,
+    pts BIGINT,
+    PRIMARY KEY (season, team_id, position, postseason)
+);
+"""
+
+# A player's team in a game, for rows loaded before player_game carried it: the one team of the
+# game the player is known to have played for, when that is unambiguous
+backfill_team_id = """
+UPDATE player_game
+SET team_id = matches.team_id
+FROM (
+    SELECT player_game.player_id, player_game.game_id, MIN(team_game.team_id) AS team_id
+    FROM player_game
+    INNER JOIN team_game ON team_game.game_id = player_game.game_id
+    INNER JOIN player_team ON player_team.player_id = player_game.player_id AND player_team.team_id = team_game.team_id
+    WHERE player_game.team_id IS NULL
+    GROUP BY player_game.player_id, player_game.game_id
+    HAVING COUNT(*) = 1
+) AS matches
+WHERE player_game.player_id = matches.player_id AND player_game.game_id = matches.game_id;
+"""
+
+# Season-partitioned layout: the partition key has to be part of every primary key,
+# so player_game carries the season and references game by (game_id, season)
+create_partitioned_game_table = """
+CREATE TABLE IF NOT EXISTS game (
+    game_id INT,
+    date DATE,
+    season INT NOT NULL,
+    home_team_score INT,
+    visitor_team_score INT,
+    home_team_id INT,
+    visitor_team_id INT,
+    postseason BOOLEAN,
+    row_hash BIGINT,
+    PRIMARY KEY (game_id, season),
+    FOREIGN KEY (home_team_id) REFERENCES team (team_id),
+    FOREIGN KEY (visitor_team_id) REFERENCES team (team_id)
+) PARTITION BY LIST (season);
+"""
+
+create_partitioned_player_game_table = """
+CREATE TABLE IF NOT EXISTS player_game (
+    player_id INT,
+    game_id INT,
+    min FLOAT,
+    fgm INT,
+    fga INT,
+    fg_pct FLOAT,
+    fg3m INT,
+    fg3a INT,
+    fg3_pct FLOAT,
+    ftm INT,
+    fta INT,
+    ft_pct FLOAT,
+    oreb INT,
+    dreb INT,
+    reb INT,
+    ast INT,
+    stl INT,
+    blk INT,
+    turnover INT,
+    pf INT,
+    pts INT,
+    season INT NOT NULL,
+    team_id INT,
+    row_hash BIGINT,
+    PRIMARY KEY (player_id, game_id, season),
+    FOREIGN KEY (player_id) REFERENCES player (player_id),
+    FOREIGN KEY (game_id, season) REFERENCES game (game_id, season)
+) PARTITION BY LIST (season);
+"""
+
+# team_game cannot reference game (game_id) once game_id alone is no longer unique
+create_partitioned_team_game_table = """
+CREATE TABLE IF NOT EXISTS team_game (
+    team_id int,
+    game_id int,
+    PRIMARY KEY (team_id, game_id),
+    FOREIGN KEY (team_id) REFERENCES team (team_id)
+);
+"""
+
+# Indexes behind the per-season rollups in query.sql
+create_indexes = """
+CREATE INDEX IF NOT EXISTS game_season_idx ON game (season);
+CREATE INDEX IF NOT EXISTS player_game_game_id_idx ON player_game (game_id);
+CREATE INDEX IF NOT EXISTS team_game_game_id_idx ON team_game (game_id);
+CREATE INDEX IF NOT EXISTS ingest_checkpoint_status_idx ON ingest_checkpoint (status, date);
+"""
+
+def create_season_partitions(table):
+    for season in range(FIRST_SEASON, LAST_SEASON + 1):
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_{season} PARTITION OF {table} FOR VALUES IN ({season});")
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT;")
+
+def is_partitioned(table_name):
+    cursor.execute("SELECT EXISTS (SELECT FROM pg_partitioned_table WHERE partrelid = to_regclass(%s));", [table_name])
+    return cursor.fetchone()[0]
+
+def add_missing_columns():
+    # Older databases predate these columns; season is backfilled from game, the others come with new loads
+    # (a NULL row_hash counts as changed, so the first merge rewrites those rows once)
+    cursor.execute("ALTER TABLE game ADD COLUMN IF NOT EXISTS postseason BOOLEAN;")
+    cursor.execute("ALTER TABLE player_game ADD COLUMN IF NOT EXISTS season INT;")
+    cursor.execute("ALTER TABLE player_game ADD COLUMN IF NOT EXISTS team_id INT;")
+    cursor.execute("ALTER TABLE game ADD COLUMN IF NOT EXISTS row_hash BIGINT;")
+    cursor.execute("ALTER TABLE player_game ADD COLUMN IF NOT EXISTS row_hash BIGINT;")
+    cursor.execute("UPDATE player_game SET season = game.season FROM game WHERE player_game.game_id = game.game_id AND player_game.season IS NULL;")
+
+def migrate_to_partitioned():
+    # Rename the heap tables out of the way, create the partitioned ones and copy every row across
+    add_missing_columns()
+    cursor.execute("ALTER TABLE player_game RENAME TO player_game_legacy;")
+    cursor.execute("ALTER TABLE player_game_legacy RENAME CONSTRAINT player_game_pkey TO player_game_legacy_pkey;")
+    cursor.execute("ALTER TABLE game RENAME TO game_legacy;")
+    cursor.execute("ALTER TABLE game_legacy RENAME CONSTRAINT game_pkey TO game_legacy_pkey;")
+    cursor.execute("ALTER TABLE team_game DROP CONSTRAINT IF EXISTS team_game_game_id_fkey;")
+    cursor.execute("DROP INDEX IF EXISTS game_season_idx, player_game_game_id_idx;")
+
+    cursor.execute(create_partitioned_game_table)
+    create_season_partitions('game')
+    cursor.execute(create_partitioned_player_game_table)
+    create_season_partitions('player_game')
+
+    game_columns = "game_id, date, season, home_team_score, visitor_team_score, home_team_id, visitor_team_id, postseason, row_hash"
+    cursor.execute(f"INSERT INTO game ({game_columns}) SELECT {game_columns} FROM game_legacy;")
+    print(f"Moved {cursor.rowcount} rows into partitioned 'game'.")
+    player_game_columns = """player_id, game_id, min, fgm, fga, fg_pct, fg3m, fg3a, fg3_pct, ftm, fta, ft_pct,
+               oreb, dreb, reb, ast, stl, blk, turnover, pf, pts, season, team_id, row_hash"""
+    cursor.execute(f"INSERT INTO player_game ({player_game_columns}) SELECT {player_game_columns} FROM player_game_legacy;")
+    print(f"Moved {cursor.rowcount} rows into partitioned 'player_game'.")
+    cursor.execute("DROP TABLE player_game_legacy, game_legacy;")
+
 # Function to check if table exists
 def check_table_exists(table_name):
     cursor.execute(f"SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = '{table_name}');")
@@ -145,16 +463,31 @@ if not check_table_exists('player'):
 else:
     print("Table 'player' already exists.")
 
+if args.partitioned and args.migrate and check_table_exists('game') and not is_partitioned('game'):
+    migrate_to_partitioned()
+    print("Tables 'game' and 'player_game' migrated to season partitions.")
+
 if not check_table_exists('game'):
-    cursor.execute(create_game_table)
-    print("Table 'game' created successfully.")
+    if args.partitioned:
+        cursor.execute(create_partitioned_game_table)
+        create_season_partitions('game')
+        print("Table 'game' created successfully (partitioned by season).")
+    else:
+        cursor.execute(create_game_table)
+        print("Table 'game' created successfully.")
 else:
     print("Table 'game' already exists.")
 
 if not check_table_exists('player_game'):
-    cursor.execute(create_player_game_table)
-    print("Table 'player_game' created successfully.")
+    if args.partitioned:
+        cursor.execute(create_partitioned_player_game_table)
+        create_season_partitions('player_game')
+        print("Table 'player_game' created successfully (partitioned by season).")
+    else:
+        cursor.execute(create_player_game_table)
+        print("Table 'player_game' created successfully.")
 else:
+    add_missing_columns()
     print("Table 'player_game' already exists.")
 
 if not check_table_exists('player_team'):
@@ -164,11 +497,55 @@ else:
     print("Table 'player_team' already exists.")
 
 if not check_table_exists('team_game'):
-    cursor.execute(create_team_game_table)
+    cursor.execute(create_partitioned_team_game_table if is_partitioned('game') else create_team_game_table)
     print("Table 'team_game' created successfully.")
 else:
     print("Table 'team_game' already exists.")
 
+if not check_table_exists('ingest_checkpoint'):
+    cursor.execute(create_ingest_checkpoint_table)
+    print("Table 'ingest_checkpoint' created successfully.")
+else:
+    # Leases arrived with distributed ingest
+    cursor.execute("ALTER TABLE ingest_checkpoint ADD COLUMN IF NOT EXISTS leased_by VARCHAR(100);")
+    cursor.execute("ALTER TABLE ingest_checkpoint ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP;")
+    print("Table 'ingest_checkpoint' already exists.")
+
+if not check_table_exists('dead_letter'):
+    cursor.execute(create_dead_letter_table)
+    print("Table 'dead_letter' created successfully.")
+else:
+    print("Table 'dead_letter' already exists.")
+
+if not check_table_exists('api_quota'):
+    cursor.execute(create_api_quota_table)
+    print("Table 'api_quota' created successfully.")
+else:
+    print("Table 'api_quota' already exists.")
+
+if not check_table_exists('game_aggregate'):
+    cursor.execute(create_game_aggregate_table)
+    cursor.execute(create_season_aggregate_table)
+    print("Tables 'game_aggregate' and 'season_aggregate' created successfully.")
+    print("Run 'python aggregates.py rebuild' in box_score/ to backfill them from existing games.")
+else:
+    print("Tables 'game_aggregate' and 'season_aggregate' already exist.")
+
+cursor.execute(backfill_team_id)
+if cursor.rowcount:
+    print(f"Backfilled the team of {cursor.rowcount} player_game rows.")
+
+if not check_table_exists('rollup_cube'):
+    cursor.execute(create_rollup_cube_game_table)
+    cursor.execute(create_rollup_cube_table)
+    print("Tables 'rollup_cube_game' and 'rollup_cube' created successfully.")
+    print("Run 'python cube.py rebuild' in box_score/ to backfill them from existing games.")
+else:
+    print("Tables 'rollup_cube_game' and 'rollup_cube' already exist.")
+
+cursor.execute(create_indexes)
+print("Indexes on game.season, player_game.game_id, team_game.game_id and ingest_checkpoint.status are in place.")
+
 # Commit the transaction
 conn.commit()
 
@@ -21,3 +21,10 @@ execute_psql "DROP TABLE IF EXISTS player_game CASCADE;"
 execute_psql "DROP TABLE IF EXISTS player_team CASCADE;"
 execute_psql "DROP TABLE IF EXISTS team_game CASCADE;"
 execute_psql "DROP TABLE IF EXISTS player CASCADE;"
+execute_psql "DROP TABLE IF EXISTS ingest_checkpoint CASCADE;"
+execute_psql "DROP TABLE IF EXISTS api_quota CASCADE;"
+execute_psql "DROP TABLE IF EXISTS dead_letter CASCADE;"
+execute_psql "DROP TABLE IF EXISTS game_aggregate CASCADE;"
+execute_psql "DROP TABLE IF EXISTS season_aggregate CASCADE;"
+execute_psql "DROP TABLE IF EXISTS rollup_cube_game CASCADE;"
+execute_psql "DROP TABLE IF EXISTS rollup_cube CASCADE;"
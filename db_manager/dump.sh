@@ -16,27 +16,15 @@ if [ -z "$DB_USER" ]; then
     exit 1
 fi
 
-# Create the directory if it doesn't exist
-output_dir="data"
-output_file="${output_dir}/box_scores.sql"
+# Export the tables to season-partitioned Parquet under data/export; extra arguments go to export.py,
+# e.g. --format arrow or --full
+echo "Running export..."
+python box_score/export.py "$@"
 
-if [ ! -d "$output_dir" ]; then
-    echo "Output directory does not exist. Creating $output_dir..."
-    mkdir -p "$output_dir"
-    if [ $? -ne 0 ]; then
-        echo "Failed to create directory $output_dir"
-        exit 1
-    fi
-fi
-
-# Dump postgresql database into .sql file
-echo "Running pg_dump..."
-pg_dump -U "$DB_USER" -d box_scores -f "$output_file"
-
-# Check if pg_dump was successful
+# Check if the export was successful
 if [ $? -eq 0 ]; then
-    echo "Database dump successful."
+    echo "Database export successful."
 else
-    echo "Database dump failed."
+    echo "Database export failed."
     exit 1
 fi
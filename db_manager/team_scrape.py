@@ -1,23 +1,21 @@
 import os
+import sys
 from dotenv import load_dotenv
-import requests
 import psycopg2
 import json
 
+# Share the box_score HTTP client so team requests reuse its pool and rate limit
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'box_score'))
+import client
+
 # Take environment variables from .env.
 load_dotenv()
 
 # API Configuration
-API_KEY = os.getenv("API_KEY")
-API_ENDPOINT = "https://api.balldontlie.io/v1/teams"
-
-# Set up the headers with the API key.
-headers = {
-    'Authorization': API_KEY
-}
+API_ENDPOINT = "teams"
 
 # Make the GET reqeuest
-response = requests.get(API_ENDPOINT, headers=headers)
+response = client.get(API_ENDPOINT)
 response_json = response.json()
 
 # PostgreSQL connection details